@@ -17,25 +17,493 @@
 """See docstring for JSSImporter class."""
 
 
+import atexit
 from collections import OrderedDict
-from distutils.version import StrictVersion
+from contextlib import contextmanager
+import errno
+import fcntl
+from functools import partial
+import hashlib
+import importlib
+import json
+from multiprocessing.pool import ThreadPool
 import os
+import random
+import re
 import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
 from xml.etree import ElementTree
+import zipfile
 
-import jss
-# Ensure that python-jss dependency is at minimum version
 try:
-    from jss import __version__ as PYTHON_JSS_VERSION
+    from urllib.parse import urlparse
 except ImportError:
-    PYTHON_JSS_VERSION = "0.0.0"
+    from urlparse import urlparse
+
 from autopkglib import Processor, ProcessorError
 
 
 __all__ = ["JSSImporter"]
 __version__ = "0.5.1"
-REQUIRED_PYTHON_JSS_VERSION = StrictVersion("1.4.0")
+REQUIRED_PYTHON_JSS_VERSION = "1.4.0"
+# Read files in 1 MiB chunks when calculating checksums.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Timestamp for every entry in zipped bundle-style packages.
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+# Distribution points left mounted by JSS_MOUNT_SESSION, shared by all
+# JSSImporter runs in this process. "processors" maps each DP
+# configuration (see get_mount_key()) to the last processor to use it.
+MOUNT_SESSION = {"processors": {}, "timer": None, "atexit": False}
+# Seconds to wait for a mounted DP to list its contents before deciding
+# that the mount is stale.
+MOUNT_PROBE_TIMEOUT = 10
+# Pooled HTTP sessions, shared by all JSSImporter runs in this process.
+HTTP_SESSIONS = {}
+HTTP_SESSIONS_LOCK = threading.Lock()
+# Responses meaning that the JSS (or its load balancer) is too busy, and
+# the request can be retried.
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+MAX_RETRY_DELAY = 60
+# Stream uploads in 1 MiB chunks, reporting progress every 10 seconds.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10
+# Tokenized templates, shared by all JSSImporter runs in this process.
+TEMPLATE_CACHE = {}
+TEMPLATE_CACHE_LOCK = threading.Lock()
+# Results of find_file_in_search_path(), shared by all JSSImporter runs
+# in this process.
+SEARCH_PATH_CACHE = {}
+SEARCH_PATH_CACHE_LOCK = threading.Lock()
+# Objects retrieved from the JSS, shared by all JSSImporter runs in this
+# process (see get_jss_object()).
+OBJECT_CACHE = {}
+OBJECT_CACHE_LOCK = threading.Lock()
+# The Timings and output method of the JSSImporter run each thread is
+# working for, so that HTTP requests (and their progress and retries) can
+# be attributed to the right run.
+TIMING_CONTEXT = threading.local()
+TIMINGS_FILE_LOCK = threading.Lock()
+# Path segments of JSS API URLs which identify a particular object.
+OBJECT_KEY_PATTERN = re.compile(r"/(id|name)/[^/]+")
+OBJECT_ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class LazyModule(object):
+    """A module which is imported the first time it is used.
+
+    AutoPkg imports the processors of every recipe it runs, including
+    recipes which stop before JSSImporter runs (e.g. when there is no
+    new download). python-jss (which brings in urllib3 and its object
+    model) and requests are imported on first use instead, so loading
+    JSSImporter is cheap.
+
+    Args:
+        name: The name of the module.
+        setup: Function to call with the module once it is imported,
+            if any.
+    """
+
+    def __init__(self, name, setup=None):
+        self.__name = name
+        self.__setup = setup
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            module = importlib.import_module(self.__name)
+            if self.__setup is not None:
+                self.__setup(module)
+            self.__module = module
+        return getattr(self.__module, attr)
+
+
+def fix_upload_headers(module):
+    """Make python-jss send JDS and CDP uploads' FILE_TYPE as a string.
+
+    python-jss 1.x sends the header as an int, which requests (since
+    2.11) refuses to send, so uploads to a JDS or CDP fail. Later
+    versions of python-jss use strings, and are left alone.
+    """
+    distribution_point = getattr(module, "distribution_point", None)
+    for name in ("PKG_FILE_TYPE", "SCRIPT_FILE_TYPE"):
+        if hasattr(distribution_point, name):
+            setattr(distribution_point, name,
+                    str(getattr(distribution_point, name)))
+
+
+# pylint: disable=invalid-name
+jss = LazyModule("jss", setup=fix_upload_headers)
+requests = LazyModule("requests")
+# pylint: enable=invalid-name
+
+
+class Template(object):
+    """Text with embedded %tags%, tokenized once for repeated use.
+
+    A tag is a key wrapped in "%" characters, e.g. %VERSION%. Keys may
+    not contain whitespace.
+    """
+    # Zero-width, so that overlapping candidates (e.g. "%a%b%") are all
+    # found; render() decides which of them are actually tags.
+    tag_pattern = re.compile(r"(?=%([^%\s]+)%)")
+
+    def __init__(self, text):
+        self.text = text
+        self.tags = [(match.start(), match.start() + len(match.group(1)) + 2,
+                      match.group(1)) for match in
+                     self.tag_pattern.finditer(text)]
+
+    def render(self, replace_dict):
+        """Substitute values for tags in a single pass.
+
+        Substituted values are never themselves searched for tags, and
+        the result doesn't depend on the order of replace_dict. Tags
+        with no value in replace_dict are left as they are.
+
+        Args:
+            replace_dict: A dict, where
+                key: Corresponds to the % delimited tag in text.
+                value: Text to swap in.
+
+        Returns:
+            Tuple of the text after replacement, and a list of the
+            keys of any unresolved tags.
+        """
+        output = []
+        unresolved = []
+        position = 0
+        for start, end, key in self.tags:
+            if start < position:
+                # This "%" was part of the previous tag.
+                continue
+            if key in replace_dict:
+                output.append(self.text[position:start])
+                output.append(replace_dict[key])
+                position = end
+            elif key not in unresolved:
+                unresolved.append(key)
+        output.append(self.text[position:])
+        return "".join(output), unresolved
+
+
+class UploadProgress(object):
+    """File-like wrapper for a request body which reports progress.
+
+    Reads are limited to UPLOAD_CHUNK_SIZE, so a file being uploaded is
+    streamed in chunks rather than read into memory, whatever its size.
+    Progress, throughput, and the estimated time remaining are reported
+    every PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, source, total, label, log):
+        self.source = source
+        self.total = total
+        self.label = label
+        self.log = log
+        self.sent = 0
+        self.start = self.last_report = time.time()
+
+    def read(self, size=-1):
+        """Read the next chunk of the source, and report progress."""
+        if size is None or size < 0 or size > UPLOAD_CHUNK_SIZE:
+            size = UPLOAD_CHUNK_SIZE
+        data = self.source.read(size)
+        self.sent += len(data)
+        now = time.time()
+        if data and (now - self.last_report >= PROGRESS_INTERVAL or
+                     self.sent == self.total):
+            self.last_report = now
+            self.report(now)
+        return data
+
+    def seek(self, offset, whence=0):
+        """Seek the source, e.g. to start again for a retry."""
+        self.source.seek(offset, whence)
+        self.sent = self.source.tell()
+        self.start = time.time()
+
+    def tell(self):
+        """Return the source's position."""
+        return self.source.tell()
+
+    def report(self, now):
+        """Output upload progress."""
+        elapsed = max(now - self.start, 0.001)
+        rate = self.sent / elapsed
+        if self.total:
+            remaining = (self.total - self.sent) / rate if rate else 0
+            self.log("Uploading %s: %d%% (%s of %s, %s/s, %d:%02d "
+                     "remaining)" % (self.label, 100 * self.sent / self.total,
+                                     format_size(self.sent),
+                                     format_size(self.total),
+                                     format_size(rate), remaining // 60,
+                                     remaining % 60))
+        else:
+            self.log("Uploading %s: %s (%s/s)" % (
+                self.label, format_size(self.sent), format_size(rate)))
+
+
+def format_size(size):
+    """Return a human-readable string for a number of bytes."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def get_endpoint(path):
+    """Return a URL path without the parts identifying an object.
+
+    e.g. "/JSSResource/policies/id/42" becomes
+    "/JSSResource/policies/id/{id}".
+    """
+    path = OBJECT_KEY_PATTERN.sub(r"/\1/{\1}", path)
+    return OBJECT_ID_PATTERN.sub("/{id}", path)
+
+
+def get_origin(url):
+    """Return the (scheme, host, port) a URL is served from."""
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    return (scheme, (parsed.hostname or "").lower(),
+            parsed.port or DEFAULT_PORTS.get(scheme))
+
+
+class Timings(object):
+    """Wall time spent on each part of a JSSImporter run.
+
+    Times are recorded for phases of the run (e.g. "package" or
+    "policy"), individual JSS objects, copies to distribution points,
+    and HTTP requests. Each record has the "start" of the activity, in
+    seconds since the run started (phases may overlap when run
+    concurrently), and the number of "seconds" it took.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.objects = []
+        self.copies = []
+        self.http = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, records, start=None, **fields):
+        """Time the body of a with statement, adding it to records.
+
+        Args:
+            records: The list to add the record to.
+            start: The time the activity started, if before the with
+                statement. Defaults to now.
+            fields: Fields to include in the record.
+
+        Yields:
+            The record's dict of fields, so that more can be added.
+        """
+        start = start or time.time()
+        fields["start"] = round(start - self.start, 6)
+        try:
+            yield fields
+        finally:
+            fields["seconds"] = round(time.time() - start, 6)
+            with self.lock:
+                records.append(fields)
+
+    def phase(self, name):
+        """Time a phase of the run."""
+        return self.timed(self.phases, name=name)
+
+    def object(self, type_, name, start=None):
+        """Time looking up, and creating or updating, a JSS object."""
+        return self.timed(self.objects, start, type=type_, name=name)
+
+    def copy(self, filename, distribution_point):
+        """Time copying a file to a distribution point."""
+        return self.timed(self.copies, file=filename,
+                          distribution_point=distribution_point)
+
+    def add_request(self, request, start, response=None, error=None):
+        """Record an HTTP request, and its response or error."""
+        path = urlparse(request.url).path
+        record = {"method": request.method, "path": path,
+                  "endpoint": get_endpoint(path),
+                  "bytes_sent": int(request.headers.get("Content-Length") or
+                                    0),
+                  "start": round(start - self.start, 6),
+                  "seconds": round(time.time() - start, 6)}
+        if response is not None:
+            record["status"] = response.status_code
+            record["bytes_received"] = int(
+                response.headers.get("Content-Length") or 0)
+        else:
+            record["error"] = str(error)
+        with self.lock:
+            self.http.append(record)
+
+    def merge(self, other, **fields):
+        """Add the records of another run's Timings to these.
+
+        Their start times are adjusted to be since this run began.
+
+        Args:
+            other: The Timings to add.
+            fields: Fields to add to each record, e.g. which run it
+                came from.
+        """
+        offset = other.start - self.start
+        with other.lock:
+            records = [(self.phases, list(other.phases)),
+                       (self.objects, list(other.objects)),
+                       (self.copies, list(other.copies)),
+                       (self.http, list(other.http))]
+        with self.lock:
+            for ours, theirs in records:
+                ours.extend(dict(record, start=round(
+                    record["start"] + offset, 6), **fields)
+                            for record in theirs)
+
+    def as_dict(self):
+        """Return the timings, with HTTP requests totalled by endpoint."""
+        endpoints = {}
+        with self.lock:
+            for record in self.http:
+                total = endpoints.setdefault(
+                    "%s %s" % (record["method"], record["endpoint"]),
+                    {"requests": 0, "seconds": 0, "bytes_sent": 0,
+                     "bytes_received": 0})
+                total["requests"] += 1
+                total["seconds"] = round(total["seconds"] + record["seconds"],
+                                         6)
+                total["bytes_sent"] += record["bytes_sent"]
+                total["bytes_received"] += record.get("bytes_received", 0)
+            return {"seconds": round(time.time() - self.start, 6),
+                    "phases": list(self.phases),
+                    "objects": list(self.objects),
+                    "copies": list(self.copies),
+                    "http": list(self.http),
+                    "endpoints": endpoints}
+
+
+class PooledHTTPAdapter(object):
+    """Transport adapter with a default timeout, retries, and pool stats.
+
+    Requests are sent with a requests HTTPAdapter, which the adapter
+    wraps rather than subclasses, so that requests isn't imported until
+    a session is needed (see LazyModule).
+
+    Requests which fail with a connection error, a timeout, or a
+    "busy" status (see RETRY_STATUS_CODES) are retried up to retries
+    times, with exponential backoff and full jitter: the nth retry
+    waits a random time of up to backoff * 2 ** n seconds (capped at
+    MAX_RETRY_DELAY).
+
+    POST requests aren't idempotent, so they are only retried if the
+    connection could not be made at all (see is_connect_error()); a
+    POST the JSS may have received is never sent twice.
+
+    Uploads (requests with a file as their body, e.g. packages and
+    scripts copied to a JDS or CDP) are streamed through UploadProgress,
+    which reports their progress.
+
+    Each request (including every retry) is recorded in the Timings of
+    the JSSImporter run the calling thread is working for, if any (see
+    TIMING_CONTEXT). Upload progress and retries are reported with that
+    run's output method, so that in a batch (where recipes share
+    sessions) they are labelled with the right recipe.
+    """
+
+    def __init__(self, timeout=None, retries=0, backoff=1.0, **kwargs):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.adapter = requests.adapters.HTTPAdapter(**kwargs)
+
+    def send(self, request, **kwargs):   # pylint: disable=arguments-differ
+        """Send a request, retrying if it fails."""
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        idempotent = request.method.upper() in IDEMPOTENT_METHODS
+        log = getattr(TIMING_CONTEXT, "output", None)
+        if hasattr(request.body, "read") and log:
+            request.body = UploadProgress(
+                request.body, int(request.headers.get("Content-Length") or 0),
+                request.headers.get("FILE_NAME", request.url), log)
+        timings = getattr(TIMING_CONTEXT, "timings", None)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.adapter.send(request, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as error:
+                if timings is not None:
+                    timings.add_request(request, start, error=error)
+                retryable = idempotent or self.is_connect_error(error)
+                if attempt >= self.retries or not retryable:
+                    raise
+                reason = error
+                retry_after = None
+            else:
+                if timings is not None:
+                    timings.add_request(request, start, response=response)
+                if (response.status_code not in RETRY_STATUS_CODES or
+                        attempt >= self.retries or not idempotent):
+                    return response
+                reason = "HTTP %s" % response.status_code
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+
+            attempt += 1
+            if hasattr(request.body, "seek"):
+                request.body.seek(0)
+            delay = self.get_retry_delay(attempt, retry_after)
+            if log:
+                log("%s %s failed (%s); retrying in %.1f seconds (%d of "
+                    "%d)." % (request.method, request.url, reason, delay,
+                              attempt, self.retries))
+            time.sleep(delay)
+
+    def is_connect_error(self, error):   # pylint: disable=no-self-use
+        """Return whether a request failed before any of it was sent.
+
+        i.e. the connection was refused, the host couldn't be found,
+        or connecting timed out. Errors once connected (e.g. the
+        connection being reset, or a read timeout) don't count, as the
+        JSS may have received the request.
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        # requests wraps urllib3's MaxRetryError, whose reason is what
+        # actually went wrong.
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, "reason", reason)
+        return isinstance(
+            reason, requests.packages.urllib3.exceptions.ConnectTimeoutError)
+
+    def close(self):
+        """Close the adapter's connections."""
+        self.adapter.close()
+
+    def get_retry_delay(self, attempt, retry_after=None):
+        """Return the number of seconds to wait before a retry."""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        return random.uniform(
+            0, min(self.backoff * 2 ** (attempt - 1), MAX_RETRY_DELAY))
+
+    def get_stats(self):
+        """Return a dict of total "requests" and "connections" made."""
+        pools = self.adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        return {"requests": sum(pool.num_requests for pool in pools),
+                "connections": sum(pool.num_connections for pool in pools)}
 
 
 # pylint: disable=too-many-instance-attributes, too-many-public-methods
@@ -143,6 +611,144 @@ class JSSImporter(Processor):
                 "'False'. Defaults to 'True'.",
             "default": True,
         },
+        "JSS_COPY_WORKERS": {
+            "required": False,
+            "description":
+                "Number of distribution points to copy packages and scripts "
+                "to at the same time. Defaults to '1' (copy to each "
+                "distribution point in turn).",
+            "default": 1,
+        },
+        "JSS_POOL_SIZE": {
+            "required": False,
+            "description":
+                "Maximum number of connections to keep open to the JSS. "
+                "Defaults to '10'.",
+            "default": 10,
+        },
+        "JSS_TIMEOUT": {
+            "required": False,
+            "description":
+                "Number of seconds to wait for the JSS to respond to a "
+                "request. Defaults to '0' (wait indefinitely).",
+            "default": 0,
+        },
+        "JSS_RETRIES": {
+            "required": False,
+            "description":
+                "Number of times to retry a request if the JSS can't be "
+                "reached, times out, or is too busy (HTTP 429, 502, 503, or "
+                "504). Requests which create objects are only retried if "
+                "the JSS can't be reached. Defaults to '0'.",
+            "default": 0,
+        },
+        "JSS_RETRY_BACKOFF": {
+            "required": False,
+            "description":
+                "Number of seconds to wait, at most, before the first retry "
+                "of a failed request. The most to wait doubles with each "
+                "retry, and the actual wait is random. Defaults to '1'.",
+            "default": 1,
+        },
+        "JSS_KEEP_ALIVE": {
+            "required": False,
+            "description":
+                "If set to False, connections to the JSS are closed after "
+                "each request rather than reused. Defaults to 'True'.",
+            "default": True,
+        },
+        "JSS_DRY_RUN": {
+            "required": False,
+            "description":
+                "If set to True, work out what would be added or updated, "
+                "and report it in jss_changed_objects and "
+                "jss_importer_summary_result, without saving anything to the "
+                "JSS or copying anything to the distribution points. "
+                "Defaults to 'False'.",
+            "default": False,
+        },
+        "JSS_WORKERS": {
+            "required": False,
+            "description":
+                "Number of JSS objects (e.g. extension attributes, groups, "
+                "and scripts) to create or update at the same time. Objects "
+                "which depend on others, like the policy, wait for them. "
+                "Defaults to '1' (handle each object in turn).",
+            "default": 1,
+        },
+        "JSS_BATCH_WORKERS": {
+            "required": False,
+            "description":
+                "When importing a batch of recipes (see process_batch()), "
+                "the number of recipes to import at the same time. Defaults "
+                "to '1' (import each recipe in turn).",
+            "default": 1,
+        },
+        "JSS_TIMINGS_FILE": {
+            "required": False,
+            "description":
+                "Path to a file to save jss_importer_timings to. If the "
+                "path ends in '.jsonl', the timings are appended as a line "
+                "of JSON, along with the recipe's name; otherwise, the file "
+                "is replaced with the timings as JSON. Defaults to '' "
+                "(don't save the timings).",
+            "default": "",
+        },
+        "JSS_MOUNT_SESSION": {
+            "required": False,
+            "description":
+                "If set to True, AFP and SMB distribution points are left "
+                "mounted after the recipe finishes, and reused by later "
+                "recipes, until the AutoPkg run ends or they have been idle "
+                "for JSS_MOUNT_IDLE_TIMEOUT seconds. Defaults to 'False'.",
+            "default": False,
+        },
+        "JSS_MOUNT_IDLE_TIMEOUT": {
+            "required": False,
+            "description":
+                "Number of seconds distribution points mounted by "
+                "JSS_MOUNT_SESSION may go unused before they are unmounted. "
+                "Defaults to '300'.",
+            "default": 300,
+        },
+        "JSS_OBJECT_CACHE_TTL": {
+            "required": False,
+            "description":
+                "Number of seconds to cache objects retrieved from the JSS "
+                "(e.g. categories and static groups), so that later recipes "
+                "in the same AutoPkg run (or batch) don't need to retrieve "
+                "them again. Objects about to be updated are always "
+                "retrieved. Set to '0' to disable caching. Defaults to "
+                "'3600'.",
+            "default": 3600,
+        },
+        "JSS_BYPASS_CACHE": {
+            "required": False,
+            "description":
+                "If set to True, always retrieve objects from the JSS rather "
+                "than from the cache. Defaults to 'False'.",
+            "default": False,
+        },
+        "JSS_STATE_JOURNAL": {
+            "required": False,
+            "description":
+                "If set to True, record a fingerprint of each successful "
+                "run's inputs, rendered templates, and files, along with "
+                "the ids of the objects it used. A later run of the same "
+                "recipe against the same JSS with the same fingerprint "
+                "is skipped. Defaults to 'False'.",
+            "default": False,
+        },
+        "JSS_STATE_VERIFY": {
+            "required": False,
+            "description":
+                "If set to True, a run skipped by JSS_STATE_JOURNAL first "
+                "checks that the objects recorded for it still exist on the "
+                "JSS with the same ids, and does a full run if not. If set "
+                "to False, the run is skipped without contacting the JSS. "
+                "Defaults to 'True'.",
+            "default": True,
+        },
         "category": {
             "required": False,
             "description":
@@ -233,6 +839,17 @@ class JSSImporter(Processor):
             "required": False,
             "description": "Name of the target Site",
         },
+        "targets": {
+            "required": False,
+            "description":
+                "Array of target dictionaries, to import the recipe to "
+                "several sites or JSS instances at the same time. Each "
+                "target's keys override the recipe's input variables, "
+                "e.g. 'site_id' and 'site_name', or 'JSS_URL', "
+                "'API_USERNAME', 'API_PASSWORD', and 'JSS_REPOS'. A file "
+                "copied to a distribution point shared by several targets "
+                "is only uploaded once.",
+        },
     }
     output_variables = {
         "jss_changed_objects": {
@@ -241,13 +858,29 @@ class JSSImporter(Processor):
         "jss_importer_summary_result": {
             "description": "Description of interesting results."
         },
+        "jss_importer_timings": {
+            "description":
+                "Dictionary of the time taken by each phase of the run, "
+                "each JSS object, each copy to a distribution point, and "
+                "each HTTP request, with requests totalled by endpoint."
+        },
+        "jss_batch_results": {
+            "description":
+                "When importing a batch of recipes, a list of each recipe's "
+                "name, jss_changed_objects, and error (if it failed)."
+        },
+        "jss_target_results": {
+            "description":
+                "When importing to several targets, a list of each target's "
+                "name, jss_changed_objects, and error (if it failed)."
+        },
     }
     description = __doc__
 
     def __init__(self, env=None, infile=None, outfile=None):
         """Sets attributes here."""
         super(JSSImporter, self).__init__(env, infile, outfile)
-        self.jss = None
+        self._jss = None
         self.pkg_name = None
         self.prod_name = None
         self.version = None
@@ -259,20 +892,303 @@ class JSSImporter(Processor):
         self.groups = None
         self.scripts = None
         self.policy = None
+        self.file_checksums = None
+        self.dp_manifest = None
+        self.icon_registry = None
+        self.checksum_lock = threading.RLock()
+        self.cache_lock = threading.RLock()
+        self.object_indexes = {}
+        self.change_buffer = threading.local()
+        self.worker_slots = None
+        self.pool_stats = None
+        self.object_locks = {}
+        self.copied = set()
+        self.batch_name = None
+        self.timings = Timings()
 
     def main(self):
         """Main processor code."""
-        # Ensure we have the right version of python-jss
-        python_jss_version = StrictVersion(PYTHON_JSS_VERSION)
-        if python_jss_version < REQUIRED_PYTHON_JSS_VERSION:
-            self.output("Requires python-jss version: %s. Installed: %s" %
-                        (REQUIRED_PYTHON_JSS_VERSION, python_jss_version))
-            sys.exit()
-
+        # Time the run, including HTTP requests made by any thread
+        # working for it (see run_tasks() and copy()), and every
+        # target's run (see process_batch()).
+        self.timings = Timings()
+        TIMING_CONTEXT.timings = self.timings
+        TIMING_CONTEXT.output = self.output
+        try:
+            if self.env.get("targets"):
+                self.process_targets(self.env["targets"])
+            else:
+                self.import_product()
+        finally:
+            TIMING_CONTEXT.timings = TIMING_CONTEXT.output = None
+            self.save_timings()
+
+    @property
+    def jss(self):
+        """The JSS client, created the first time it is needed.
+
+        A run which turns out to have nothing to do (see
+        JSS_STATE_JOURNAL) may never need a client, or the DPs which
+        come with it.
+        """
+        if self._jss is None:
+            with self.cache_lock:
+                if self._jss is None:
+                    # In a batch, the version is checked once for every
+                    # recipe by process_batch().
+                    if self.batch_name is None:
+                        self.check_python_jss_version()
+                    self._jss = self.get_jss_client()
+                    self.use_pooled_session()
+        return self._jss
+
+    @jss.setter
+    def jss(self, client):
+        self._jss = client
+
+    def import_product(self):
+        """Add or update the product's objects, and copy its package."""
         # clear any pre-existing summary result
         if "jss_importer_summary_result" in self.env:
             del self.env["jss_importer_summary_result"]
 
+        self.pkg_name = os.path.basename(self.env["pkg_path"])
+        self.prod_name = self.env["prod_name"]
+        self.version = self.env["version"]
+
+        # Build and init jss_changed_objects
+        self.init_jss_changed_objects()
+        if self.env.get("JSS_DRY_RUN"):
+            self.output("Dry run: nothing will be saved to the JSS or copied "
+                        "to distribution points.")
+        with self.timings.phase("prepare_package"):
+            self.prepare_package()
+        # Build our text replacement dictionary
+        self.build_replace_dict()
+
+        # Skip the run if nothing has changed since the last successful
+        # one.
+        fingerprint = None
+        if self.env.get("JSS_STATE_JOURNAL"):
+            with self.timings.phase("journal"):
+                fingerprint = self.get_run_fingerprint()
+                unchanged = self.journal_matches(fingerprint)
+            if unchanged:
+                return
+
+        # Look up which objects already exist all at once.
+        with self.timings.phase("indexes"):
+            self.prefetch_object_indexes()
+
+        try:
+            # Get our DPs read for copying (in a batch, they are
+            # already mounted). If mounting fails partway, the DPs
+            # that were mounted are still released below.
+            if self.batch_name is None:
+                with self.timings.phase("mount"):
+                    self.mount_distribution_points()
+            # Smart groups may use extension attributes in their
+            # criteria, and the policy needs everything else to exist
+            # first.
+            tasks = [
+                ("category", partial(self.handle_category, "category"), []),
+                ("policy_category",
+                 partial(self.handle_category, "policy_category"), []),
+                ("package", self.handle_package, ["category"]),
+                ("extattrs", self.handle_extension_attributes, []),
+                ("groups", self.handle_groups, ["extattrs"]),
+                ("scripts", self.handle_scripts, []),
+                ("policy", self.handle_policy,
+                 ["policy_category", "package", "groups", "scripts"]),
+                ("icon", self.handle_icon, ["policy"])]
+            self.run_tasks([(name, partial(self.run_phase, name, func),
+                             dependencies)
+                            for name, func, dependencies in tasks])
+        finally:
+            # Done with DPs, unmount them (unless they are still
+            # needed), even if something went wrong.
+            if self.batch_name is None:
+                with self.timings.phase("release"):
+                    self.release_distribution_points()
+
+        self.summarize()
+        if fingerprint and not self.env.get("JSS_DRY_RUN"):
+            self.update_journal(fingerprint)
+        if self.batch_name is None:
+            self.output_pool_stats()
+
+    def run_phase(self, name, func):
+        """Call func, timing it as a phase of the run."""
+        with self.timings.phase(name):
+            return func()
+
+    def save_timings(self):
+        """Output the run's timings, and save them to JSS_TIMINGS_FILE.
+
+        The timings are put in jss_importer_timings, and the slowest
+        phases are listed with -vv.
+        """
+        timings = self.timings.as_dict()
+        self.env["jss_importer_timings"] = timings
+        phases = sorted(timings["phases"], key=lambda phase: phase["seconds"],
+                        reverse=True)
+        self.output("Took %.2f seconds (%s), with %d HTTP requests." % (
+            timings["seconds"], ", ".join(
+                "%s %.2fs" % (phase["name"], phase["seconds"])
+                for phase in phases[:5]), len(timings["http"])),
+                    verbose_level=2)
+
+        path = self.env.get("JSS_TIMINGS_FILE")
+        if not path:
+            return
+        path = os.path.expanduser(path)
+        with TIMINGS_FILE_LOCK:
+            if path.endswith(".jsonl"):
+                with open(path, "a") as timings_file:
+                    timings_file.write(json.dumps(dict(
+                        timings, recipe=self.get_recipe_name(),
+                        time=self.timings.start)) + "\n")
+            else:
+                with open(path, "w") as timings_file:
+                    json.dump(timings, timings_file, indent=2)
+
+    def get_run_fingerprint(self):
+        """Return a fingerprint of everything a run's result depends on.
+
+        This covers the recipe's input variables, the distribution
+        points, each template rendered as it would be for the run, and
+        the checksums of the package, scripts, and icon (which are
+        cached, so unchanged files aren't read again).
+
+        Returns:
+            String SHA-256 hex digest.
+        """
+        inputs = {key: self.env.get(key) for key in self.input_variables
+                  if key == key.lower()}
+        inputs["JSS_REPOS"] = self.env.get("JSS_REPOS")
+        inputs["JSS_MIGRATED"] = self.env.get("JSS_MIGRATED")
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(
+            [__version__, inputs], sort_keys=True, default=repr).encode(
+                "utf-8"))
+
+        # Optional inputs, and keys missing from them (which the
+        # handlers report), are left out rather than raising here.
+        templates = [(self.env.get("policy_template"), self.replace_dict)]
+        templates.extend(
+            (extattr.get("ext_attribute_path"), self.replace_dict)
+            for extattr in self.env.get("extension_attributes") or [])
+        templates.extend(
+            (group.get("template_path"), self.get_group_replace_dict(group))
+            for group in self.env.get("groups") or []
+            if self.validate_input_var(group) and group.get("smart") and
+            group.get("name"))
+        files = [script.get("name")
+                 for script in self.env.get("scripts") or []]
+        templates.extend(
+            (script.get("template_path"), self.replace_dict)
+            for script in self.env.get("scripts") or [])
+        if self.package_handling_enabled() and self.env.get("pkg_path"):
+            files.append(self.env["pkg_path"])
+        if self.env.get("self_service_icon"):
+            files.append(self.env["self_service_icon"])
+
+        for path, replace_dict in templates:
+            if path:
+                text, _ = self.get_template(
+                    self.find_file_in_search_path(path)).render(replace_dict)
+                if not isinstance(text, bytes):
+                    text = text.encode("utf-8")
+                fingerprint.update(hashlib.sha256(text).digest())
+        for path in files:
+            if path:
+                fingerprint.update(self.get_file_checksum(
+                    self.find_file_in_search_path(path))["sha256"].encode(
+                        "utf-8"))
+        return fingerprint.hexdigest()
+
+    def journal_matches(self, fingerprint):
+        """Return whether a run can be skipped, per the state journal.
+
+        The run can be skipped if the last successful run of the
+        recipe against this JSS had the same fingerprint (see
+        get_run_fingerprint()) and, if JSS_STATE_VERIFY is set, the
+        objects it used are still on the JSS with the same ids.
+        """
+        with self.checksum_lock:
+            entry = self.load_cache_file("state_journal.json").get(
+                self.env["JSS_URL"], {}).get(self.get_recipe_key())
+        if not entry or entry["fingerprint"] != fingerprint:
+            return False
+        if self.env.get("JSS_STATE_VERIFY"):
+            for cls_name, name, id_ in entry["objects"]:
+                index = self.get_object_index(getattr(jss, cls_name))
+                if str(index.get(name.lower())) != str(id_):
+                    self.output("%s '%s' has changed on the JSS since the "
+                                "last successful run; importing." %
+                                (cls_name, name))
+                    return False
+        self.output("Nothing has changed since the last successful run "
+                    "(%s); skipping." % time.strftime(
+                        "%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])))
+        return True
+
+    def update_journal(self, fingerprint):
+        """Record a successful run in the state journal.
+
+        The journal is kept in the AutoPkg cache, keyed by JSS URL and
+        recipe (see get_recipe_key()). Each entry has the run's
+        fingerprint and time, and the type, name, and id of each
+        object the run used.
+        """
+        objects = [self.category, self.policy_category, self.package,
+                   self.policy]
+        objects[3:3] = ((self.extattrs or []) + (self.groups or []) +
+                        (self.scripts or []))
+        entry = {
+            "fingerprint": fingerprint, "time": time.time(),
+            "objects": [[obj.__class__.__name__, obj.name, obj.id]
+                        for obj in objects if obj is not None]}
+        with self.checksum_lock:
+            journal = self.load_cache_file("state_journal.json")
+            journal.setdefault(self.env["JSS_URL"], {})[
+                self.get_recipe_key()] = entry
+            self.save_cache_file("state_journal.json", journal)
+
+    def get_recipe_key(self):
+        """Return a key identifying the recipe being run.
+
+        Runs of a recipe for different sites (see process_targets())
+        are kept apart.
+        """
+        key = self.env.get("RECIPE_PATH") or self.get_recipe_name()
+        site = self.env.get("site_id") or self.env.get("site_name")
+        return "%s (site %s)" % (key, site) if site else key
+
+    def get_recipe_name(self):
+        """Return the name of the recipe being run."""
+        return (self.env.get("NAME") or
+                os.path.basename(self.env.get("RECIPE_PATH") or "") or
+                self.env.get("prod_name") or "")
+
+    def output(self, msg, verbose_level=1):
+        """Print a message, prefixed with the recipe's name in a batch."""
+        if self.batch_name is not None:
+            msg = "[%s] %s" % (self.batch_name, msg)
+        super(JSSImporter, self).output(msg, verbose_level)
+
+    def check_python_jss_version(self):
+        """Ensure we have the right version of python-jss."""
+        from distutils.version import StrictVersion
+        python_jss_version = StrictVersion(
+            getattr(jss, "__version__", "0.0.0"))
+        if python_jss_version < StrictVersion(REQUIRED_PYTHON_JSS_VERSION):
+            self.output("Requires python-jss version: %s. Installed: %s" %
+                        (REQUIRED_PYTHON_JSS_VERSION, python_jss_version))
+            sys.exit()
+
+    def get_jss_client(self):
+        """Return a new JSS client for the recipe's JSS and repos."""
         # pull jss recipe-specific args, prep api auth
         repo_url = self.env["JSS_URL"]
         auth_user = self.env["API_USERNAME"]
@@ -281,35 +1197,565 @@ class JSSImporter(Processor):
         jss_migrated = self.env["JSS_MIGRATED"]
         suppress_warnings = self.env["JSS_SUPPRESS_WARNINGS"]
         repos = self.env["JSS_REPOS"]
-        self.jss = jss.JSS(url=repo_url, user=auth_user, password=auth_pass,
-                           ssl_verify=ssl_verify, repo_prefs=repos,
-                           jss_migrated=jss_migrated,
-                           suppress_warnings=suppress_warnings)
-        self.pkg_name = os.path.basename(self.env["pkg_path"])
-        self.prod_name = self.env["prod_name"]
-        self.version = self.env["version"]
+        return jss.JSS(url=repo_url, user=auth_user, password=auth_pass,
+                       ssl_verify=ssl_verify, repo_prefs=repos,
+                       jss_migrated=jss_migrated,
+                       suppress_warnings=suppress_warnings)
 
-        # Build and init jss_changed_objects
-        self.init_jss_changed_objects()
+    def get_client_settings(self):
+        """Return a hashable key for the recipe's JSS client settings.
 
-        self.category = self.handle_category("category")
-        self.policy_category = self.handle_category("policy_category")
+        Recipes with the same key can share a client (see
+        process_batch()).
+        """
+        return (self.get_session_settings() +
+                (json.dumps(self.env["JSS_REPOS"], sort_keys=True),
+                 self.env["JSS_MIGRATED"], self.env["JSS_SUPPRESS_WARNINGS"]))
 
-        # Get our DPs read for copying.
-        self.jss.distribution_points.mount()
-        self.package = self.handle_package()
-        # Build our text replacement dictionary
-        self.build_replace_dict()
+    def execute_batch(self):
+        """Execute a batch of recipes as a standalone binary.
+
+        Like execute_shell(), but the input plist's "recipes" array
+        holds a dict of input variables for each recipe, and every
+        other key applies to all of them (see process_batch()).
+        """
+        try:
+            self.read_input_plist()
+            self.parse_arguments()
+            recipe_envs = self.env.pop("recipes", [])
+            try:
+                self.process_batch(recipe_envs)
+            finally:
+                self.write_output_plist()
+        except ProcessorError as error:
+            sys.stderr.write("ProcessorError: %s\n" % error)
+            sys.exit(10)
+        else:
+            sys.exit(0)
+
+    def process_batch(self, recipe_envs, names=None,
+                      results_key="jss_batch_results", workers=None):
+        """Import several recipes in one session.
+
+        Each recipe is run by its own JSSImporter, with its input
+        variables layered over this processor's env (so preferences
+        like JSS_URL need only be given once). Rather than each recipe
+        setting itself up:
+            - The python-jss version is checked once.
+            - Recipes using the same JSS and connection settings share
+              a JSS client, its connections, and its object indexes.
+            - All recipes share the object, checksum, and DP caches.
+            - The DPs are mounted once, and released (see
+              release_distribution_points()) once every recipe is done.
+
+        Up to JSS_BATCH_WORKERS recipes are imported at a time. A
+        recipe failing doesn't stop the others.
+
+        Every recipe's changes are merged into jss_changed_objects and
+        jss_importer_summary_result, and its timings into this
+        processor's (see Timings.merge()). Each recipe's outcome is
+        listed in jss_batch_results.
+
+        Args:
+            recipe_envs: List of dicts of each recipe's input
+                variables.
+            names: List of each recipe's name, for output. Defaults to
+                each recipe's NAME, RECIPE_PATH, or prod_name.
+            results_key: The env key to list each recipe's outcome in.
+            workers: Number of recipes to import at a time. Defaults
+                to JSS_BATCH_WORKERS.
 
-        self.extattrs = self.handle_extension_attributes()
-        self.groups = self.handle_groups()
-        self.scripts = self.handle_scripts()
-        self.policy = self.handle_policy()
-        self.handle_icon()
-        # Done with DPs, unmount them.
-        self.jss.distribution_points.umount()
+        Raises:
+            ProcessorError if any recipe failed, once every recipe has
+            been imported.
+        """
+        self.check_python_jss_version()
+        processors = []
+        clients = OrderedDict()
+        for number, recipe_env in enumerate(recipe_envs, 1):
+            env = dict(self.env)
+            env.update(recipe_env)
+            for variable, flags in self.input_variables.items():
+                if "default" in flags:
+                    env.setdefault(variable, flags["default"])
+            processor = JSSImporter(env=env)
+            if names:
+                processor.batch_name = names[number - 1]
+            else:
+                processor.batch_name = (processor.get_recipe_name() or
+                                        "recipe %d" % number)
+            processor.share_caches(self)
+            try:
+                key = processor.get_client_settings()
+            except KeyError as error:
+                raise ProcessorError("%s: missing required input variable "
+                                     "%s." % (processor.batch_name, error))
+            if key not in clients:
+                clients[key] = processor
+            else:
+                processor.jss = clients[key].jss
+                processor.object_indexes = clients[key].object_indexes
+            processors.append(processor)
+
+        def import_recipe(processor):
+            """Import a recipe, returning the exception if it fails."""
+            try:
+                processor.process()
+            except Exception as error:  # pylint: disable=broad-except
+                return error
+            return None
+
+        mounted = []
+        try:
+            for processor in clients.values():
+                # Added first, so that DPs mounted before a failure are
+                # released.
+                mounted.append(processor)
+                processor.mount_distribution_points()
+            pool = ThreadPool(max(1, int(
+                workers or self.env.get("JSS_BATCH_WORKERS") or 1)))
+            try:
+                errors = pool.map(import_recipe, processors)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for processor in mounted:
+                processor.release_distribution_points()
 
+        self.init_jss_changed_objects()
+        self.env[results_key] = []
+        for processor, error in zip(processors, errors):
+            changes = processor.env.get("jss_changed_objects", {})
+            for key, names in changes.items():
+                self.env["jss_changed_objects"].setdefault(key, []).extend(
+                    names)
+            self.timings.merge(processor.timings, run=processor.batch_name)
+            result = {"name": processor.batch_name,
+                      "jss_changed_objects": changes,
+                      "jss_importer_timings":
+                          processor.env.get("jss_importer_timings", {})}
+            if error is not None:
+                result["error"] = str(error)
+                self.output("%s failed: %s" % (processor.batch_name, error))
+            self.env[results_key].append(result)
+        if "jss_importer_summary_result" in self.env:
+            del self.env["jss_importer_summary_result"]
         self.summarize()
+        for processor in clients.values():
+            processor.output_pool_stats()
+
+        failed = [result["name"] for result in self.env[results_key]
+                  if "error" in result]
+        if failed:
+            raise ProcessorError("%d of %d recipes failed: %s" % (
+                len(failed), len(processors), ", ".join(failed)))
+
+    def process_targets(self, targets):
+        """Import the recipe to several sites or JSS instances at once.
+
+        Each target is a dict of input variables layered over the
+        recipe's (e.g. site_id and site_name, or JSS_URL, API_USERNAME,
+        API_PASSWORD, and JSS_REPOS), and gets its own templates
+        rendered and objects created or updated. The targets are all
+        imported at the same time, as a batch (see process_batch()), so
+        targets on the same JSS share a client. A package or script
+        copied to a DP shared by several targets is only uploaded once
+        (see copy()); the other targets' objects just refer to it.
+
+        Each target's outcome is listed in jss_target_results. The
+        targets' timings are saved as part of the recipe's, rather than
+        separately (see main()).
+        """
+        recipe_name = self.get_recipe_name()
+        names = ["%s @ %s" % (recipe_name, self.get_target_name(target,
+                                                                number))
+                 for number, target in enumerate(targets, 1)]
+        self.process_batch([dict(target, targets=None, JSS_TIMINGS_FILE=None)
+                            for target in targets],
+                           names=names, results_key="jss_target_results",
+                           workers=len(targets))
+
+    def get_target_name(self, target, number):  # pylint: disable=no-self-use
+        """Return a name for a target (see process_targets())."""
+        parts = [target.get("JSS_URL"),
+                 target.get("site_name") or target.get("site_id")]
+        return (" ".join(str(part) for part in parts if part) or
+                "target %d" % number)
+
+    def share_caches(self, owner):
+        """Use another processor's caches and their locks.
+
+        See process_batch().
+        """
+        self.checksum_lock = owner.checksum_lock
+        self.cache_lock = owner.cache_lock
+        self.object_locks = owner.object_locks
+        self.copied = owner.copied
+        self.file_checksums = owner.get_file_checksums()
+        self.dp_manifest = owner.get_dp_manifest()
+        self.icon_registry = owner.get_icon_registries()
+
+    def use_pooled_session(self):
+        """Give the JSS client a pooled HTTP session.
+
+        Sessions are configured with JSS_POOL_SIZE, JSS_TIMEOUT,
+        JSS_RETRIES, JSS_RETRY_BACKOFF, and JSS_KEEP_ALIVE (see
+        PooledHTTPAdapter), and are shared by every
+        JSSImporter run in this process with the same JSS and
+        settings, so connections are reused from recipe to recipe.
+        Package and script uploads to a JDS or CDP use the same
+        session.
+        """
+        settings = self.get_session_settings()
+        pool_size, timeout, retries, backoff, keep_alive = settings[4:]
+        with HTTP_SESSIONS_LOCK:
+            session = HTTP_SESSIONS.get(settings)
+            if session is None:
+                session = requests.Session()
+                session.auth = self.jss.session.auth
+                session.verify = self.jss.session.verify
+                session.headers.update(self.jss.session.headers)
+                if not keep_alive:
+                    session.headers["Connection"] = "close"
+                adapter = PooledHTTPAdapter(
+                    timeout=timeout, retries=retries, backoff=backoff,
+                    pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                HTTP_SESSIONS[settings] = session
+        self.jss.session = session
+        if self.pool_stats is None:
+            self.pool_stats = self.get_pool_adapter().get_stats()
+
+    def get_session_settings(self):
+        """Return the settings a pooled HTTP session is shared by."""
+        pool_size = int(self.env.get("JSS_POOL_SIZE") or 10)
+        timeout = float(self.env.get("JSS_TIMEOUT") or 0) or None
+        retries = int(self.env.get("JSS_RETRIES") or 0)
+        backoff = float(self.env.get("JSS_RETRY_BACKOFF", 1))
+        keep_alive = bool(self.env.get("JSS_KEEP_ALIVE", True))
+        return (self.env["JSS_URL"], self.env["API_USERNAME"],
+                self.env["API_PASSWORD"], self.env["JSS_VERIFY_SSL"],
+                pool_size, timeout, retries, backoff, keep_alive)
+
+    def get_pool_adapter(self):
+        """Return the PooledHTTPAdapter used to talk to the JSS."""
+        return self.jss.session.get_adapter(self.env["JSS_URL"])
+
+    def output_pool_stats(self):
+        """Output connection pool use for this run, if verbose."""
+        if self._jss is None:
+            # Nothing was sent to the JSS.
+            return
+        start = self.pool_stats
+        stats = self.get_pool_adapter().get_stats()
+        requests_made = stats["requests"] - start["requests"]
+        connections = stats["connections"] - start["connections"]
+        if not self.env.get("JSS_KEEP_ALIVE", True):
+            self.output("HTTP connection pool: %d requests, connections not "
+                        "reused (JSS_KEEP_ALIVE is off)." % requests_made,
+                        verbose_level=2)
+            return
+        self.output("HTTP connection pool: %d requests, %d reused "
+                    "connections (hits), %d new connections (misses)." %
+                    (requests_made, max(0, requests_made - connections),
+                     connections), verbose_level=2)
+
+    def mount_distribution_points(self):
+        """Mount the DPs, reusing any healthy existing mounts.
+
+        This process is registered as using the DPs, so that other
+        JSSImporter processes on this host won't unmount them while
+        they are in use.
+
+        In a dry run, nothing is mounted; DPs which aren't already
+        mounted are reported as needing the package copied to them.
+        """
+        if self.env.get("JSS_DRY_RUN"):
+            self.output("Dry run: not mounting distribution points.")
+            return
+        with self.mount_lock():
+            if MOUNT_SESSION["timer"] is not None:
+                MOUNT_SESSION["timer"].cancel()
+                MOUNT_SESSION["timer"] = None
+            self.update_mount_holders(add=True)
+            for repo in self.get_distribution_points():
+                if not hasattr(repo, "mount"):
+                    continue
+                dp_name = self.get_distribution_point_name(repo)
+                if self.mount_is_healthy(repo):
+                    self.output("Reusing mounted %s" % dp_name)
+                    continue
+                if hasattr(repo, "is_mounted") and repo.is_mounted():
+                    self.output("Remounting unresponsive %s" % dp_name)
+                    repo.umount()
+                repo.mount()
+
+    def release_distribution_points(self):
+        """Finish using the DPs for this recipe.
+
+        With JSS_MOUNT_SESSION, the DPs stay mounted for the next recipe
+        until the process exits or the idle timeout passes, when the
+        DPs of every recipe in the session are unmounted. Otherwise,
+        they are unmounted, unless another JSSImporter process is still
+        using them.
+
+        In a dry run, the DPs weren't mounted, so nothing happens.
+        """
+        if self.env.get("JSS_DRY_RUN"):
+            return
+        if self.env.get("JSS_MOUNT_SESSION"):
+            with self.mount_lock():
+                MOUNT_SESSION["processors"][self.get_mount_key()] = self
+                if not MOUNT_SESSION["atexit"]:
+                    atexit.register(self.end_mount_session)
+                    MOUNT_SESSION["atexit"] = True
+                timer = threading.Timer(
+                    float(self.env.get("JSS_MOUNT_IDLE_TIMEOUT") or 0),
+                    self.end_mount_session)
+                timer.args = (timer,)
+                timer.daemon = True
+                MOUNT_SESSION["timer"] = timer
+                timer.start()
+            self.output("Leaving distribution points mounted for reuse.")
+        else:
+            self.unmount_distribution_points()
+
+    def end_mount_session(self, timer=None):
+        """Unmount all the DPs left mounted by JSS_MOUNT_SESSION.
+
+        Recipes may have used different DPs (JSS_REPOS), so each
+        configuration's DPs are unmounted by the last processor to use
+        them.
+
+        Args:
+            timer: The idle timer calling this method, if any. If
+                another recipe has since used the DPs, nothing happens.
+        """
+        # Hold the lock while deciding, so that a recipe can't start
+        # using the DPs between the check and the unmount.
+        with self.mount_lock():
+            if timer is not None and timer is not MOUNT_SESSION["timer"]:
+                return
+            processors = list(MOUNT_SESSION["processors"].values())
+            MOUNT_SESSION["processors"].clear()
+            MOUNT_SESSION["timer"] = None
+            for processor in processors:
+                try:
+                    processor.unmount_unused_distribution_points()
+                except Exception as error:  # pylint: disable=broad-except
+                    # Carry on, so the other DPs are still unmounted.
+                    processor.output("Unable to unmount distribution "
+                                     "points: %s" % error)
+
+    def unmount_distribution_points(self):
+        """Unmount the DPs, unless another process is using them."""
+        with self.mount_lock():
+            # They no longer need unmounting at the end of a session.
+            MOUNT_SESSION["processors"].pop(self.get_mount_key(), None)
+            self.unmount_unused_distribution_points()
+
+    def get_mount_key(self):
+        """Return a key for the recipe's DP configuration."""
+        return (self.env["JSS_URL"],
+                json.dumps(self.env.get("JSS_REPOS"), sort_keys=True))
+
+    def unmount_unused_distribution_points(self):
+        """Unmount the DPs, unless another process is using them.
+
+        Must be called while holding mount_lock().
+        """
+        holders = self.update_mount_holders(add=False)
+        if holders:
+            self.output("Distribution points still in use by process(es) "
+                        "%s; leaving them mounted." %
+                        ", ".join(sorted(holders)))
+        else:
+            self.jss.distribution_points.umount()
+
+    def mount_is_healthy(self, repo):   # pylint: disable=no-self-use
+        """Return whether a DP is mounted and responding.
+
+        Listing a stale network mount can hang, so the mount is listed
+        in another thread, and is unhealthy if that doesn't finish
+        within MOUNT_PROBE_TIMEOUT seconds.
+        """
+        if not hasattr(repo, "is_mounted") or not repo.is_mounted():
+            return False
+        try:
+            mount_point = repo.connection["mount_point"]
+        except KeyError:
+            return False
+        result = {}
+
+        def probe():
+            """List the mount point, noting whether that worked."""
+            try:
+                os.listdir(mount_point)
+            except OSError:
+                return
+            result["healthy"] = True
+
+        thread = threading.Thread(target=probe)
+        # A hung probe mustn't keep AutoPkg from exiting.
+        thread.daemon = True
+        thread.start()
+        thread.join(MOUNT_PROBE_TIMEOUT)
+        return result.get("healthy", False)
+
+    @contextmanager
+    def mount_lock(self):
+        """Hold an exclusive, host-wide lock on mounting the DPs."""
+        with open(self.get_cache_path("mount.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update_mount_holders(self, add):
+        """Add or remove this process from the DP users.
+
+        Must be called while holding mount_lock().
+
+        Args:
+            add: Bool whether to add (True) or remove (False) this
+                process.
+
+        Returns:
+            List of the ids of other running processes using the DPs.
+        """
+        holders = self.load_cache_file("mount_holders.json")
+        pid = str(os.getpid())
+        # Forget about processes which have exited.
+        for holder in list(holders):
+            try:
+                os.kill(int(holder), 0)
+            except OSError as error:
+                if error.errno != errno.EPERM:
+                    del holders[holder]
+            except ValueError:
+                del holders[holder]
+        if add:
+            holders[pid] = time.time()
+        else:
+            holders.pop(pid, None)
+        self.save_cache_file("mount_holders.json", holders)
+        return [holder for holder in holders if holder != pid]
+
+    def run_tasks(self, tasks):
+        """Run tasks concurrently, each once its dependencies are done.
+
+        Up to JSS_WORKERS tasks run at a time; with one worker, the
+        tasks are run in order in this thread. Tasks may run tasks of
+        their own (e.g. with map_concurrently()); those share the same
+        JSS_WORKERS limit, with the calling task giving up its place
+        while it waits for them. Changes recorded by each task (see
+        record_change()) are added to jss_changed_objects in task
+        order, regardless of which task finished first.
+
+        Args:
+            tasks: List of (name, callable, dependencies) tuples, in an
+                order in which they could be run one at a time.
+                dependencies is a list of the names of tasks which must
+                finish first. If this processor has an attribute named
+                name, it is set to the task's return value before any
+                dependent tasks start.
+
+        Returns:
+            List of the tasks' return values, in task order.
+
+        Raises:
+            The first exception raised by a task, once all tasks which
+            don't depend on a failed task have finished.
+        """
+        workers = int(self.env.get("JSS_WORKERS") or 1)
+        outcomes = OrderedDict((name, {"done": threading.Event()})
+                               for name, _, _ in tasks)
+        parent_changes = getattr(self.change_buffer, "changes", None)
+        # Tasks are only run with changes buffered, so this is a task
+        # running tasks of its own.
+        nested = parent_changes is not None
+        if not nested:
+            self.worker_slots = threading.BoundedSemaphore(max(1, workers))
+
+        def run_task(name, func, dependencies):
+            """Run a task once its dependencies are done."""
+            outcome = outcomes[name]
+            outcome["changes"] = []
+            TIMING_CONTEXT.timings = self.timings
+            TIMING_CONTEXT.output = self.output
+            try:
+                for dependency in dependencies:
+                    outcomes[dependency]["done"].wait()
+                    if "error" in outcomes[dependency]:
+                        outcome["error"] = outcomes[dependency]["error"]
+                        return
+                with self.worker_slots:
+                    self.change_buffer.changes = outcome["changes"]
+                    outcome["result"] = func()
+                if hasattr(self, name):
+                    setattr(self, name, outcome["result"])
+            except Exception as error:  # pylint: disable=broad-except
+                outcome["error"] = error
+            finally:
+                self.change_buffer.changes = None
+                outcome["done"].set()
+
+        # The calling task's worker slot is free for the tasks it runs
+        # (if it held on to it, with one worker they could never run).
+        if nested:
+            self.worker_slots.release()
+        try:
+            if workers <= 1:
+                for task in tasks:
+                    run_task(*task)
+            else:
+                threads = [threading.Thread(target=run_task, args=task)
+                           for task in tasks]
+                for thread in threads:
+                    thread.daemon = True
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            if nested:
+                self.worker_slots.acquire()
+        self.change_buffer.changes = parent_changes
+
+        for outcome in outcomes.values():
+            for key, name in outcome.get("changes", []):
+                self.record_change(key, name)
+        for outcome in outcomes.values():
+            if "error" in outcome:
+                raise outcome["error"]
+        return [outcome.get("result") for outcome in outcomes.values()]
+
+    def map_concurrently(self, func, items):
+        """Call func on each item concurrently (see run_tasks()).
+
+        Returns:
+            List of the non-None return values, in item order.
+        """
+        results = self.run_tasks(
+            [("item %s" % index, partial(func, item), [])
+             for index, item in enumerate(items)])
+        return [result for result in results if result is not None]
+
+    def record_change(self, key, name):
+        """Record that an object was added or changed.
+
+        Args:
+            key: The jss_changed_objects key to add name to.
+            name: The name of the object which was changed.
+        """
+        changes = getattr(self.change_buffer, "changes", None)
+        if changes is not None:
+            # Running as a task: see run_tasks().
+            changes.append((key, name))
+        else:
+            self.env["jss_changed_objects"][key].append(name)
 
     def init_jss_changed_objects(self):
         """Build a dictionary to track changes to JSS objects."""
@@ -332,94 +1778,254 @@ class JSSImporter(Processor):
         """Ensure a category is present."""
         if self.env.get(category_type):
             category_name = self.env.get(category_type)
-            try:
-                category = self.jss.Category(category_name)
-                self.output("Category type: %s-'%s' already exists "
-                            "according to JSS, moving on..." %
-                            (category_type, category_name))
-            except jss.JSSGetError:
-                # Category doesn't exist
-                category = jss.Category(self.jss, category_name)
-                category.save()
-                self.output(
-                    "Category type: %s-'%s' created." % (category_type,
-                                                         category_name))
-                self.env["jss_changed_objects"]["jss_category_added"].append(
-                    category_name)
+            with self.timings.object("Category", category_name) as timing, \
+                    self.object_lock(jss.Category, category_name):
+                try:
+                    category = self.get_jss_object(jss.Category,
+                                                   category_name)
+                    self.output("Category type: %s-'%s' already exists "
+                                "according to JSS, moving on..." %
+                                (category_type, category_name))
+                    timing["action"] = "unchanged"
+                except jss.JSSGetError:
+                    # Category doesn't exist
+                    category = jss.Category(self.jss, category_name)
+                    self.save_object(category)
+                    timing["action"] = "created"
+                    self.output(
+                        "Category type: %s-'%s' created." % (category_type,
+                                                             category_name))
+                    self.record_change("jss_category_added", category_name)
         else:
             category = None
 
         return category
 
+    def prepare_package(self):
+        """Zip non-flat packages, which require zipping prior to upload.
+
+        The zip from a previous run is reused if the package hasn't
+        changed since (see zip_bundle()).
+        """
+        if (self.package_handling_enabled() and
+                os.path.isdir(self.env["pkg_path"])):
+            # Several targets (see process_targets()) may be zipping
+            # the same bundle.
+            with self.get_lock(("zip", self.env["pkg_path"])):
+                self.env["pkg_path"] = self.zip_bundle(
+                    self.env["pkg_path"], self.env["pkg_path"] + ".zip")
+            self.pkg_name += ".zip"
+
+    def zip_bundle(self, bundle, zip_path):
+        """Zip a bundle-style package, unless an up-to-date zip exists.
+
+        Zips are deterministic: entries are in sorted order and have a
+        fixed timestamp, so identical bundles produce identical zips
+        (and the package isn't uploaded again just because it was
+        re-zipped).
+
+        An existing zip is reused if the bundle's files have the same
+        names, sizes, modes, and modification times as when it was
+        made, or failing that, the same contents.
+
+        In a dry run, an existing zip is left alone: if it isn't up to
+        date, the bundle is zipped to a temporary folder instead, which
+        is removed when the process exits. Nothing is recorded.
+
+        Args:
+            bundle: Path to the bundle-style package.
+            zip_path: Path to write the zip to.
+
+        Returns:
+            Path to the zip.
+        """
+        records = self.load_cache_file("bundle_zips.json")
+        record = records.get(bundle, {})
+        entries = self.get_bundle_entries(bundle)
+        metadata = self.get_bundle_fingerprint(entries)
+        zip_current = (os.path.exists(zip_path) and
+                       record.get("zip") == self.get_zip_stat(zip_path))
+
+        if zip_current and record.get("metadata") == metadata:
+            self.output("Reusing %s (package unchanged)." % zip_path)
+            return zip_path
+        content = self.get_bundle_fingerprint(entries, content=True)
+        if zip_current and record.get("content") == content:
+            self.output("Reusing %s (package contents unchanged)." %
+                        zip_path)
+        else:
+            if self.env.get("JSS_DRY_RUN"):
+                temp_dir = tempfile.mkdtemp(prefix="JSSImporter-")
+                atexit.register(shutil.rmtree, temp_dir, True)
+                zip_path = os.path.join(temp_dir, os.path.basename(zip_path))
+                self.output("Dry run: zipping %s to %s" % (bundle, zip_path))
+            else:
+                self.output("Zipping %s" % bundle)
+            temp_path = "%s.%s.tmp" % (zip_path, os.getpid())
+            zip_file = zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED,
+                                       allowZip64=True)
+            try:
+                for arcname, path, _ in entries:
+                    zip_file.write(path, arcname)
+                    self.reset_zip_timestamp(zip_file, zip_file.filelist[-1])
+            finally:
+                zip_file.close()
+            os.rename(temp_path, zip_path)
+
+        if not self.env.get("JSS_DRY_RUN"):
+            with self.checksum_lock:
+                records = self.load_cache_file("bundle_zips.json")
+                records[bundle] = {"metadata": metadata, "content": content,
+                                   "zip": self.get_zip_stat(zip_path)}
+                self.save_cache_file("bundle_zips.json", records)
+        return zip_path
+
+    def get_bundle_entries(self, bundle):   # pylint: disable=no-self-use
+        """Return the zip entries for a bundle, in sorted order.
+
+        Returns:
+            List of (archive name, path, os.stat result) tuples, for
+            the bundle itself and every folder and file within it.
+            Archive names start with the bundle's name.
+        """
+        root = os.path.dirname(bundle)
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(bundle):
+            dirnames.sort()
+            for path in [dirpath] + [os.path.join(dirpath, filename) for
+                                     filename in sorted(filenames)]:
+                entries.append((os.path.relpath(path, root), path,
+                                os.stat(path)))
+        return entries
+
+    def get_bundle_fingerprint(self, entries, content=False):
+        """Return a fingerprint of a bundle's files.
+
+        Args:
+            entries: List of entries from get_bundle_entries().
+            content: Bool whether to fingerprint the contents of the
+                files (slow), rather than their sizes and modification
+                times (fast).
+
+        Returns:
+            String SHA-256 hex digest.
+        """
+        fingerprint = hashlib.sha256()
+        for arcname, path, stat in entries:
+            fingerprint.update(("%s\0%o\0" % (arcname, stat.st_mode)).encode(
+                "utf-8"))
+            if os.path.isdir(path):
+                continue
+            if content:
+                with open(path, "rb") as source:
+                    for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE),
+                                      b""):
+                        fingerprint.update(chunk)
+            else:
+                fingerprint.update(("%d\0%r\0" % (
+                    stat.st_size, stat.st_mtime)).encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def get_zip_stat(self, path):   # pylint: disable=no-self-use
+        """Return a zip's [size, modification time] for comparison."""
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    # pylint: disable=no-self-use
+    def reset_zip_timestamp(self, zip_file, zinfo):
+        """Give the entry just written to a zip a fixed timestamp.
+
+        ZipFile.write() uses the file's modification time, and (unlike
+        writestr()) streams the file rather than reading it into
+        memory, so the timestamp is patched in the entry's local header
+        afterwards. The central directory is written on close, from
+        zinfo.
+        """
+        zinfo.date_time = ZIP_TIMESTAMP
+        position = zip_file.fp.tell()
+        # The DOS time and date follow the signature, version, flags,
+        # and compression method.
+        zip_file.fp.seek(zinfo.header_offset + 10)
+        zip_file.fp.write(struct.pack(
+            "<HH", 0, ((ZIP_TIMESTAMP[0] - 1980) << 9 |
+                       ZIP_TIMESTAMP[1] << 5 | ZIP_TIMESTAMP[2])))
+        zip_file.fp.seek(position)
+    # pylint: enable=no-self-use
+
+    def package_handling_enabled(self):
+        """Return whether there is a package and somewhere to put it."""
+        return bool(self.env["JSS_REPOS"] and self.env["pkg_path"] != "")
+
     def handle_package(self):
         """Creates or updates, and copies a package object.
 
-        This will only upload a package if a file with the same name
-        does not already exist on a DP. If you need to force a
-        re-upload, you must delete the package on the DP first.
+        This will only upload a package to a DP if a file with the same
+        name does not already exist there, or if the package's size or
+        SHA-256 checksum differs from those recorded the last time it
+        was uploaded to that DP. If you need to force a re-upload, you
+        must delete the package on the DP first.
 
-        Further, if you are using a JDS, it will only upload a package
-        if a package object with a filename matching the AutoPkg
-        filename does not exist. If you need to force a re-upload to a
-        JDS, please delete the package object through the web interface
-        first.
+        A package file already on a DP with no recorded checksum (e.g.
+        uploaded by hand or by an older JSSImporter) is assumed to be
+        current, and its checksum is recorded for future runs.
         """
         # Skip package handling if there is no package or repos.
-        if self.env["JSS_REPOS"] and self.env["pkg_path"] != "":
+        if self.package_handling_enabled():
             os_requirements = self.env.get("os_requirements")
             package_info = self.env.get("package_info")
             package_notes = self.env.get("package_notes")
-            # See if the package is non-flat (requires zipping prior to
-            # upload).
-            if os.path.isdir(self.env["pkg_path"]):
-                shutil.make_archive(self.env["pkg_path"], "zip",
-                                    os.path.dirname(self.env["pkg_path"]),
-                                    self.pkg_name)
-                self.env["pkg_path"] += ".zip"
-                self.pkg_name += ".zip"
-
-            try:
-                package = self.jss.Package(self.pkg_name)
-                self.output("Pkg-object already exists according to JSS, "
-                            "moving on...")
-            except jss.JSSGetError:
-                # Package doesn't exist
-                package = jss.Package(self.jss, self.pkg_name)
-
-            pkg_update = (self.env[
-                "jss_changed_objects"]["jss_package_updated"])
+            package_added = False
             if self.category is not None:
                 cat_name = self.category.name
             else:
                 cat_name = ""
-            self.update_object(cat_name, package, "category", pkg_update)
-            self.update_object(os_requirements, package, "os_requirements",
-                               pkg_update)
-            self.update_object(package_info, package, "info", pkg_update)
-            self.update_object(package_notes, package, "notes", pkg_update)
+            with self.timings.object("Package", self.pkg_name) as timing, \
+                    self.object_lock(jss.Package, self.pkg_name):
+                try:
+                    package = self.get_jss_object(jss.Package, self.pkg_name,
+                                                  live=True)
+                    self.output("Pkg-object already exists according to "
+                                "JSS, moving on...")
+                except jss.JSSGetError:
+                    # Package doesn't exist
+                    package = jss.Package(self.jss, self.pkg_name)
+                    package_added = True
+                    self.record_change("jss_package_added", self.pkg_name)
+
+                # Apply all field changes and save the package once,
+                # rather than once per changed field.
+                changed = self.update_object_fields(
+                    package, [("category", cat_name),
+                              ("os_requirements", os_requirements),
+                              ("info", package_info),
+                              ("notes", package_notes)],
+                    "jss_package_updated")
+                timing["action"] = ("created" if package_added else
+                                    "updated" if changed else "unchanged")
+                if package.id is None:
+                    # A new package object with nothing to update still
+                    # needs saving before anything can be uploaded to it.
+                    self.save_object(package)
 
             # Ensure packages are on distribution point(s)
 
             # If we had to make a new package object, we know we need to
             # copy the package file, regardless of DP type. This solves
             # the issue regarding the JDS.exists() method: See
-            # python-jss docs for info.  The problem with this method is
-            # that if you cancel an AutoPkg run and the package object
-            # has been created, but not uploaded, you will need to
-            # delete the package object from the JSS before running a
-            # recipe again or it won't upload the package file.
+            # python-jss docs for info.
             #
-            # Passes the id of the newly created package object so JDS'
-            # will upload to the correct package object. Ignored by
-            # AFP/SMB.
-            if self.env["jss_changed_objects"]["jss_package_added"]:
-                self.copy(self.env["pkg_path"], id_=package.id)
-            # For AFP/SMB shares, we still want to see if the package
-            # exists.  If it's missing, copy it!
-            elif not self.jss.distribution_points.exists(
-                    os.path.basename(self.env["pkg_path"])):
-                self.copy(self.env["pkg_path"])
-            else:
+            # Otherwise, the package is copied to each DP whose copy
+            # differs from (or is missing) the package just built,
+            # according to the checksums recorded from previous
+            # uploads. See needs_copy() for details.
+            #
+            # Passes the id of the package object so JDS' will upload to
+            # the correct package object. Ignored by AFP/SMB.
+            if package_added:
+                self.copy(self.env["pkg_path"], id_=package.id,
+                          checkpoint=True)
+            elif not self.copy_if_changed(self.env["pkg_path"], package.id,
+                                          checkpoint=True):
                 self.output("Package upload not needed.")
         else:
             package = None
@@ -430,57 +2036,61 @@ class JSSImporter(Processor):
 
     def handle_extension_attributes(self):
         """Add extension attributes if needed."""
-        extattrs = self.env.get("extension_attributes")
-        results = []
-        if extattrs:
-            for extattr in extattrs:
-                extattr_object = self.update_or_create_new(
-                    jss.ComputerExtensionAttribute,
-                    extattr["ext_attribute_path"],
-                    update_env="jss_extension_attribute_added",
-                    added_env="jss_extension_attribute_updated")
-
-                results.append(extattr_object)
-        return results
+        extattrs = self.env.get("extension_attributes") or []
+
+        def handle_extension_attribute(extattr):
+            """Add or update a single extension attribute."""
+            return self.update_or_create_new(
+                jss.ComputerExtensionAttribute,
+                extattr["ext_attribute_path"],
+                update_env="jss_extension_attribute_added",
+                added_env="jss_extension_attribute_updated")
+
+        return self.map_concurrently(handle_extension_attribute, extattrs)
 
     def handle_groups(self):
         """Manage group existence and creation."""
-        groups = self.env.get("groups")
-        computer_groups = []
-        if groups:
-            for group in groups:
-                if self.validate_input_var(group):
-                    is_smart = group.get("smart", False)
-                    if is_smart:
-                        computer_group = self.add_or_update_smart_group(group)
-                    else:
-                        computer_group = (
-                            self.add_or_update_static_group(group))
-
-                    computer_groups.append(computer_group)
+        groups = [group for group in self.env.get("groups") or [] if
+                  self.validate_input_var(group)]
+
+        def handle_group(group):
+            """Add or update a single group."""
+            is_smart = group.get("smart", False)
+            if is_smart:
+                return self.add_or_update_smart_group(group)
+            else:
+                return self.add_or_update_static_group(group)
 
-        return computer_groups
+        return self.map_concurrently(handle_group, groups)
 
     def handle_scripts(self):
         """Add scripts if needed."""
-        scripts = self.env.get("scripts")
-        results = []
-        if scripts:
-            for script in scripts:
-                script_file = self.find_file_in_search_path(
-                    script["name"])
-                script_object = self.update_or_create_new(
-                    jss.Script,
-                    script["template_path"],
-                    os.path.basename(script_file),
-                    added_env="jss_script_added",
-                    update_env="jss_script_updated")
-
-                # Copy the script to the distribution points.
+        scripts = self.env.get("scripts") or []
+
+        def handle_script(script):
+            """Add or update, and copy a single script."""
+            script_file = self.find_file_in_search_path(script["name"])
+            script_name = os.path.basename(script_file)
+            script_added = (script_name.lower() not in
+                            self.get_object_index(jss.Script))
+            script_object = self.update_or_create_new(
+                jss.Script,
+                script["template_path"],
+                script_name,
+                added_env="jss_script_added",
+                update_env="jss_script_updated")
+
+            # Copy the script to the distribution points. As with
+            # packages, a new script object always needs its script
+            # copied; otherwise it is only copied to DPs whose copy
+            # differs.
+            if script_added:
                 self.copy(script_file, id_=script_object.id)
-                results.append(script_object)
+            elif not self.copy_if_changed(script_file, script_object.id):
+                self.output("Script %s upload not needed." % script_name)
+            return script_object
 
-        return results
+        return self.map_concurrently(handle_script, scripts)
 
     def handle_policy(self):
         """Create or update a policy."""
@@ -509,6 +2119,14 @@ class JSSImporter(Processor):
         # its icon XML, which is then added to the templated Policy. If
         # there is no icon information, but the recipe specifies one,
         # then FileUpload it up.
+        #
+        # Icons are compared by content rather than filename. The
+        # icons on every policy JSSImporter retrieves, and the checksum
+        # of every icon it uploads or downloads, are kept in an icon
+        # registry (see get_icon_registry()), so an icon which is
+        # already on the JSS is added to the policy by its id (when
+        # the policy is created, if possible) rather than uploaded
+        # again.
 
         # If no policy handling is desired, we can't upload an icon.
         if self.env.get("self_service_icon") and self.policy is not None:
@@ -517,21 +2135,181 @@ class JSSImporter(Processor):
                 self.env["self_service_icon"])
 
             icon_filename = os.path.basename(icon_path)
+            checksum = self.get_file_checksum(icon_path)["sha256"]
+
+            # Only upload each icon once, even if several recipes in a
+            # batch use it.
+            with self.object_lock(jss.FileUpload, checksum):
+                # Compare the policy's icon to the one provided by the
+                # recipe. If its content can't be checked, fall back to
+                # comparing filenames.
+                policy_icon = self.get_policy_icon(self.policy)
+                policy_checksum = None
+                if policy_icon is not None:
+                    policy_checksum = self.get_icon_checksum(policy_icon)
+                if policy_checksum == checksum or (
+                        policy_checksum is None and policy_icon is not None
+                        and policy_icon["filename"] == icon_filename):
+                    self.output("Icon matches existing icon, moving on...")
+                    return
+
+                known_icon = self.find_icon(checksum, icon_filename)
+                if known_icon is not None:
+                    self.link_icon(known_icon)
+                    self.output("Icon already on the JSS as %s (id %s); "
+                                "added it to the policy." %
+                                (known_icon["filename"], known_icon["id"]))
+                    return
+
+                if not self.env.get("JSS_DRY_RUN"):
+                    icon = jss.FileUpload(self.jss, "policies", "id",
+                                          self.policy.id, icon_path)
+                    icon.save()
+                    # The JSS doesn't say what id the icon was given, so
+                    # get it from the policy.
+                    policy = self.jss.factory.get_object(jss.Policy,
+                                                         self.policy.id)
+                    self.cache_object(policy)
+                    uploaded_icon = self.get_policy_icon(policy)
+                    if uploaded_icon is not None:
+                        self.register_icon(uploaded_icon, checksum)
+                    self.output("Icon uploaded to JSS.")
+                else:
+                    self.output("Dry run: would upload icon %s." %
+                                icon_filename)
+                self.record_change("jss_icon_uploaded", icon_filename)
+
+    def get_policy_icon(self, policy):   # pylint: disable=no-self-use
+        """Return a policy's Self Service icon.
 
-            # Compare the filename in the policy to the one provided by
-            # the recipe. If they don't match, we need to upload a new
-            # icon.
-            policy_filename = self.policy.findtext(
-                "self_service/self_service_icon/filename")
-            if not policy_filename == icon_filename:
-                icon = jss.FileUpload(self.jss, "policies", "id",
-                                      self.policy.id, icon_path)
-                icon.save()
-                self.env["jss_changed_objects"]["jss_icon_uploaded"].append(
-                    icon_filename)
-                self.output("Icon uploaded to JSS.")
-            else:
-                self.output("Icon matches existing icon, moving on...")
+        Returns:
+            Dict with the icon's "id", "filename", and "uri", or None
+            if the policy has no icon.
+        """
+        icon_xml = policy.find("self_service/self_service_icon")
+        if icon_xml is None or not icon_xml.findtext("id"):
+            return None
+        return {key: icon_xml.findtext(key) or ""
+                for key in ("id", "filename", "uri")}
+
+    def get_icon_checksum(self, icon):
+        """Return the SHA-256 checksum of an icon on the JSS.
+
+        Icons not in the icon registry are downloaded from their uri,
+        and added to it.
+
+        Args:
+            icon: Dict describing the icon (see get_policy_icon()).
+
+        Returns:
+            The checksum, or None if the icon couldn't be downloaded.
+        """
+        with self.checksum_lock:
+            record = self.get_icon_registry().get(icon["id"], {})
+        if record.get("sha256"):
+            return record["sha256"]
+        if not icon["uri"]:
+            return None
+        try:
+            response = self.download_icon(icon["uri"])
+            response.raise_for_status()
+        except requests.exceptions.RequestException as error:
+            self.output("Unable to download icon %s to check it: %s" %
+                        (icon["filename"], error), verbose_level=2)
+            return None
+        checksum = hashlib.sha256(response.content).hexdigest()
+        self.register_icon(icon, checksum)
+        return checksum
+
+    def download_icon(self, uri):
+        """Return the response to a request for an icon's uri.
+
+        Icons are often served by another host than the JSS (e.g. Jamf
+        Cloud's icon service), which mustn't be sent the API user's
+        credentials, so the JSS's session is only used for icons on
+        the JSS itself. Others are requested without credentials.
+        """
+        if get_origin(uri) == get_origin(self.env["JSS_URL"]):
+            return self.jss.session.get(uri)
+        return requests.get(
+            uri, verify=self.jss.session.verify,
+            timeout=float(self.env.get("JSS_TIMEOUT") or 0) or None)
+
+    def find_icon(self, checksum, filename=None):
+        """Return the icon on the JSS with a checksum, if known.
+
+        Icons seen on policies (see get_policy_icon_xml()) haven't
+        necessarily been checked. Any with the same filename are
+        checked by downloading them (once; see get_icon_checksum()).
+
+        Args:
+            checksum: The SHA-256 checksum of the icon to look for.
+            filename: The filename of the icon to look for.
+
+        Returns:
+            Dict describing the icon (see get_policy_icon()), or None.
+        """
+        with self.checksum_lock:
+            icons = [{"id": id_, "filename": record["filename"],
+                      "uri": record["uri"], "sha256": record.get("sha256")}
+                     for id_, record in self.get_icon_registry().items()]
+        icons.sort(key=lambda icon: int(icon["id"]))
+        for icon in icons:
+            if icon["sha256"] == checksum:
+                return icon
+        for icon in icons:
+            if (not icon["sha256"] and icon["filename"] == filename and
+                    self.get_icon_checksum(icon) == checksum):
+                return icon
+        return None
+
+    def link_icon(self, icon):
+        """Set the policy's icon to one already on the JSS."""
+        self_service = self.ensure_xml_structure(self.policy, "self_service")
+        for icon_xml in self_service.findall("self_service_icon"):
+            self_service.remove(icon_xml)
+        self.add_icon_to_policy(self.policy, self.make_icon_xml(icon))
+        self.save_object(self.policy, url=self.policy.get_object_url())
+        self.record_change("jss_policy_updated", self.policy.name)
+
+    def get_icon_registry(self):
+        """Return the icons known to be on this JSS.
+
+        The registry is kept in the AutoPkg cache, and shared by all
+        recipes.
+
+        Returns:
+            Dict of icon ids, each mapped to a dict of the icon's
+            "filename", "uri", and "sha256" (if known).
+        """
+        with self.checksum_lock:
+            return self.get_icon_registries().setdefault(
+                self.env["JSS_URL"], {})
+
+    def get_icon_registries(self):
+        """Return the icon registries of every JSS, by JSS URL."""
+        with self.checksum_lock:
+            if self.icon_registry is None:
+                self.icon_registry = self.load_cache_file("icons.json")
+            return self.icon_registry
+
+    def register_icon(self, icon, checksum=None):
+        """Add an icon on the JSS to the icon registry.
+
+        Nothing is registered in a dry run.
+
+        Args:
+            icon: Dict describing the icon (see get_policy_icon()).
+            checksum: The icon's SHA-256 checksum, if known.
+        """
+        if self.env.get("JSS_DRY_RUN"):
+            return
+        with self.checksum_lock:
+            record = self.get_icon_registry().setdefault(icon["id"], {})
+            record.update(filename=icon["filename"], uri=icon["uri"])
+            if checksum:
+                record["sha256"] = checksum
+            self.save_cache_file("icons.json", self.icon_registry)
 
     def summarize(self):
         """If anything has been added or updated, report back."""
@@ -539,8 +2317,13 @@ class JSSImporter(Processor):
         if [True for value in self.env["jss_changed_objects"].values()
                 if value]:
             # Create a blank summary.
+            if self.env.get("JSS_DRY_RUN"):
+                summary_text = ("Dry run: the following changes would be "
+                                "made to the JSS:")
+            else:
+                summary_text = "The following changes were made to the JSS:"
             self.env["jss_importer_summary_result"] = {
-                "summary_text": "The following changes were made to the JSS:",
+                "summary_text": summary_text,
                 "report_fields": ["Package", "Categories", "Groups", "Scripts",
                                   "Extension Attributes", "Policy", "Icon"],
                 "data": {
@@ -569,7 +2352,8 @@ class JSSImporter(Processor):
                 data["Policy"] = self.get_report_string(policy)
 
             if changes["jss_icon_uploaded"]:
-                data["Icon"] = os.path.basename(self.env["self_service_icon"])
+                data["Icon"] = self.get_report_string(
+                    changes["jss_icon_uploaded"])
 
             # Get nice strings for our list-types.
             if changes["jss_category_added"]:
@@ -590,7 +2374,8 @@ class JSSImporter(Processor):
             if extattrs:
                 data["Extension Attributes"] = self.get_report_string(extattrs)
 
-    def update_object(self, data, obj, path, update):
+    # pylint: disable=too-many-arguments
+    def update_object(self, data, obj, path, update, save=True):
         """Update an object if it differs.
 
         If a value differs between the recipe and the object, update
@@ -601,30 +2386,546 @@ class JSSImporter(Processor):
             data: Recipe string value to enforce.
             obj: JSSObject type to set data on.
             path: String path to desired XML.
-            update: Summary list object to append obj to if something
-                is changed.
+            update: jss_changed_objects key to add obj's name to if
+                something is changed.
+            save: Bool whether to save the object after changing it.
+                Set to False to collect several changes and save them
+                at once (see update_object_fields()). Defaults to True.
+
+        Returns:
+            True if the object was changed, False otherwise.
         """
         if data != obj.findtext(path):
             obj.find(path).text = data
-            obj.save()
+            if save:
+                self.save_object(obj)
             self.output("%s %s updated." % (
                 str(obj.__class__).split(".")[-1][:-2], path))
-            update.append(obj.name)
+            self.record_change(update, obj.name)
+            return True
+        return False
+    # pylint: enable=too-many-arguments
 
-    def copy(self, source_item, id_=-1):
-        """Copy a package or script using the JSS_REPOS preference."""
-        self.output("Copying %s to all distribution points." % source_item)
+    def update_object_fields(self, obj, fields, update):
+        """Update several fields of an object with a single save.
+
+        Each field that differs is changed on the object and reported
+        exactly as update_object() does, but the object is only saved
+        once, after all of the changes have been applied.
+
+        Args:
+            obj: JSSObject type to set data on.
+            fields: List of (path, data) tuples, where path is the
+                String path to the desired XML and data is the recipe
+                string value to enforce.
+            update: jss_changed_objects key to add obj's name to for
+                each changed field.
+
+        Returns:
+            List of the paths which were changed.
+        """
+        changed = [path for path, data in fields if
+                   self.update_object(data, obj, path, update, save=False)]
+        if changed:
+            self.save_object(obj)
+        return changed
 
-        def output_copy_status(connection):
-            """Output AutoPkg copying status."""
-            self.output("Copying to %s" % connection["url"])
+    def save_object(self, obj, url=None, name=None):
+        """Create or update an object on the JSS, and update the caches.
+
+        If JSS_DRY_RUN is set, nothing is saved.
+
+        Args:
+            obj: The JSSObject to save.
+            url: If given, obj replaces the existing object at this
+                URL, rather than being saved with obj.save().
+            name: String name the object is looked up with, if it
+                differs from obj's name.
+        """
+        if self.env.get("JSS_DRY_RUN"):
+            self.output("Dry run: not saving %s %s." %
+                        (obj.__class__.__name__, name or obj.name))
+            return
+        if url is not None:
+            self.jss.put(url, obj)
+            self.invalidate_cached_object(obj.__class__, name or obj.name)
+        elif obj.id is None:
+            obj.save()
+            self.cache_object(obj, name)
+        else:
+            obj.save()
+            self.invalidate_cached_object(obj.__class__, name or obj.name)
+
+    def get_jss_object(self, obj_cls, name, live=False):
+        """Return a JSS object by name, using the object cache.
+
+        Whether the object exists is checked against its type's index
+        (see get_object_index()) rather than by asking the JSS. Objects
+        retrieved from the JSS are cached in memory for
+        JSS_OBJECT_CACHE_TTL seconds, so that later recipes in the same
+        AutoPkg run (which is a single process) or batch don't need to
+        retrieve them again. Missing objects are not cached.
+
+        If JSS_BYPASS_CACHE is set, the object is always retrieved
+        from the JSS (and the cache refreshed).
+
+        Args:
+            obj_cls: The python-jss object class to retrieve.
+            name: String name of the object.
+            live: Bool whether to retrieve the object from the JSS
+                regardless of the cache. Objects which are about to be
+                compared with a template, and updated, are retrieved
+                live, so that changes made on the JSS aren't missed.
+
+        Returns:
+            An obj_cls object.
+
+        Raises:
+            jss.JSSGetError if the object doesn't exist.
+        """
+        index = self.get_object_index(obj_cls)
+        if name.lower() not in index:
+            raise jss.JSSGetError("%s: %s does not exist." %
+                                  (obj_cls.__name__, name))
+
+        key = self.get_object_cache_key(obj_cls, name)
+        if not (live or self.env.get("JSS_BYPASS_CACHE")):
+            with OBJECT_CACHE_LOCK:
+                cached = self.get_object_cache().get(key)
+            if cached is not None:
+                return obj_cls.from_string(self.jss, cached["xml"])
+
+        obj = self.jss.factory.get_object(obj_cls, int(index[name.lower()]))
+        self.cache_object(obj, name)
+        return obj
+
+    @contextmanager
+    def object_lock(self, obj_cls, name):
+        """Hold a lock on looking up, and creating, an object by name.
+
+        Concurrent tasks (and recipes in a batch) hold this while
+        checking whether an object exists and creating it, so that the
+        same object isn't created twice.
+        """
+        with self.get_lock((self.env["JSS_URL"], obj_cls.__name__,
+                            name.lower())):
+            yield
+
+    def get_lock(self, key):
+        """Return the lock for key, shared by every recipe in a batch."""
+        with self.cache_lock:
+            return self.object_locks.setdefault(key, threading.Lock())
+
+    def prefetch_object_indexes(self):
+        """Retrieve the indexes for every object type this recipe uses.
+
+        See get_object_index().
+        """
+        obj_classes = []
+        if self.env.get("category") or self.env.get("policy_category"):
+            obj_classes.append(jss.Category)
+        if self.package_handling_enabled():
+            obj_classes.append(jss.Package)
+        if self.env.get("extension_attributes"):
+            obj_classes.append(jss.ComputerExtensionAttribute)
+        if self.env.get("groups"):
+            obj_classes.append(jss.ComputerGroup)
+        if self.env.get("scripts"):
+            obj_classes.append(jss.Script)
+        if self.env.get("policy_template"):
+            obj_classes.append(jss.Policy)
+        for obj_cls in obj_classes:
+            self.get_object_index(obj_cls)
+
+    def get_object_index(self, obj_cls):
+        """Return the names and ids of all objects of a type.
+
+        The index is retrieved from the JSS with a single request the
+        first time it is needed, and kept up to date as objects are
+        created. This lets get_jss_object() tell that an object doesn't
+        exist without asking the JSS.
+
+        Returns:
+            Dict of lowercase object names (the JSS doesn't consider
+            case when looking up objects by name) mapped to their ids.
+        """
+        with self.cache_lock:
+            index = self.object_indexes.get(obj_cls.__name__)
+        if index is None:
+            index = {item.name.lower(): item.id for item in
+                     self.jss.factory.get_object(obj_cls, None)}
+            with self.cache_lock:
+                index = self.object_indexes.setdefault(obj_cls.__name__,
+                                                       index)
+        return index
+
+    def cache_object(self, obj, name=None):
+        """Add an object retrieved from (or saved to) the JSS to the caches.
+
+        The object is added to the object cache and to its type's
+        index (see get_object_index()).
 
-        self.jss.distribution_points.copy(source_item, id_=id_,
-                                          pre_callback=output_copy_status)
-        self.env["jss_changed_objects"]["jss_repo_updated"].append(
-            os.path.basename(source_item))
+        Args:
+            obj: The JSSObject to cache.
+            name: String name it was looked up with. Defaults to the
+                object's name.
+        """
+        with self.cache_lock:
+            self.get_object_index(obj.__class__)[obj.name.lower()] = obj.id
+        if not float(self.env.get("JSS_OBJECT_CACHE_TTL") or 0):
+            return
+        key = self.get_object_cache_key(obj.__class__, name or obj.name)
+        with OBJECT_CACHE_LOCK:
+            self.get_object_cache()[key] = {
+                "time": time.time(),
+                "xml": ElementTree.tostring(obj).decode("ascii")}
+
+    def invalidate_cached_object(self, obj_cls, name):
+        """Remove an object which has been changed from the cache."""
+        key = self.get_object_cache_key(obj_cls, name)
+        with OBJECT_CACHE_LOCK:
+            self.get_object_cache().pop(key, None)
+
+    def get_object_cache(self):
+        """Return the object cache, without any expired objects.
+
+        Call with OBJECT_CACHE_LOCK held.
+
+        Returns:
+            Dict of cache keys (see get_object_cache_key()) mapped to a
+            dict with the "time" the object was cached and its "xml".
+        """
+        expiry = time.time() - float(self.env.get("JSS_OBJECT_CACHE_TTL") or 0)
+        for key in [key for key, value in OBJECT_CACHE.items()
+                    if value["time"] <= expiry]:
+            del OBJECT_CACHE[key]
+        return OBJECT_CACHE
+
+    def get_object_cache_key(self, obj_cls, name):
+        """Return the object cache key for an object.
+
+        Like the object indexes (see get_object_index()), names are
+        lowercased, so an object is cached once however it is named.
+        """
+        return "%s|%s|%s" % (self.env["JSS_URL"], obj_cls.__name__,
+                             name.lower())
+
+    def copy(self, source_item, id_=-1, distribution_points=None,
+             checkpoint=False):
+        """Copy a package or script using the JSS_REPOS preference.
+
+        Distribution points are copied to concurrently, using up to
+        JSS_COPY_WORKERS threads. Every distribution point is attempted
+        even if copying to another one fails. The checksum of
+        source_item is recorded for each distribution point it is
+        successfully copied to.
+
+        A file is only copied to a DP once per batch (or set of
+        targets; see process_targets()): other recipes copying the
+        same file to the same DP wait for the first, and then skip it.
+
+        Args:
+            source_item: Path to the file to copy.
+            id_: Id of the package or script object to upload to (only
+                used by JDS and CDP distribution points).
+            distribution_points: List of distribution point objects to
+                copy to. Defaults to all of them.
+            checkpoint: Bool whether to keep an upload checkpoint beside
+                source_item while copying (see get_upload_checkpoint()).
+
+        Raises:
+            ProcessorError if the copy to any distribution point
+            failed. The message lists which distribution points did
+            and did not succeed.
+        """
+        self.output("Copying %s to all distribution points." % source_item)
+        if distribution_points is None:
+            distribution_points = self.get_distribution_points()
+        if self.env.get("JSS_DRY_RUN"):
+            self.output("Dry run: not copying to %s." % ", ".join(
+                self.get_distribution_point_name(repo) for repo in
+                distribution_points))
+            self.record_change("jss_repo_updated",
+                               os.path.basename(source_item))
+            return
+        checksum = self.get_file_checksum(source_item)
+        workers = max(1, min(int(self.env.get("JSS_COPY_WORKERS") or 1),
+                             len(distribution_points) or 1))
+
+        already_copied = []
+
+        def copy_to_distribution_point(repo):
+            """Copy source_item to a single DP, returning any error."""
+            dp_name = self.get_distribution_point_name(repo)
+            copy_key = (dp_name, os.path.basename(source_item),
+                        checksum["sha256"])
+            with self.get_lock(("copy",) + copy_key):
+                if copy_key in self.copied:
+                    self.output("Already copied to %s during this run." %
+                                dp_name)
+                    already_copied.append(dp_name)
+                    return dp_name, None
+                result = copy_file(repo, dp_name)
+                if result[1] is None:
+                    self.copied.add(copy_key)
+                return result
+
+        def copy_file(repo, dp_name):
+            """Copy source_item to a DP, returning any error."""
+            self.output("Copying to %s" % dp_name)
+            if checkpoint:
+                self.update_upload_checkpoint(source_item, checksum, dp_name,
+                                              complete=False)
+            TIMING_CONTEXT.timings = self.timings
+            TIMING_CONTEXT.output = self.output
+            try:
+                with self.timings.copy(os.path.basename(source_item),
+                                       dp_name) as timing:
+                    timing["bytes"] = checksum["size"]
+                    # Repositories copy packages and scripts
+                    # separately; dispatch by file type, as
+                    # DistributionPoints.copy() does.
+                    if jss.tools.is_package(source_item):
+                        repo.copy_pkg(source_item, id_)
+                    else:
+                        repo.copy_script(source_item, id_)
+            except Exception as error:  # pylint: disable=broad-except
+                self.output("Failed to copy to %s: %s" % (dp_name, error))
+                return dp_name, error
+            self.record_checksum(repo, source_item, checksum)
+            if checkpoint:
+                self.update_upload_checkpoint(source_item, checksum, dp_name,
+                                              complete=True)
+            self.output("Copied to %s" % dp_name)
+            return dp_name, None
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(copy_to_distribution_point,
+                               distribution_points)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = ["%s (%s)" % (dp_name, error) for dp_name, error in results
+                  if error is not None]
+        if failed:
+            succeeded = [dp_name for dp_name, error in results
+                         if error is None]
+            raise ProcessorError(
+                "Unable to copy %s to distribution point(s): %s. Copied "
+                "successfully to: %s" % (source_item, ", ".join(failed),
+                                         ", ".join(succeeded) or "none"))
+
+        if distribution_points and (len(already_copied) ==
+                                    len(distribution_points)):
+            return
+        self.record_change("jss_repo_updated", os.path.basename(source_item))
         self.output("Copied %s" % source_item)
 
+    def copy_if_changed(self, source_item, id_, checkpoint=False):
+        """Copy a file to each DP whose copy of it differs.
+
+        See needs_copy() and copy().
+
+        Returns:
+            True if the file was copied to any DPs, False otherwise.
+        """
+        checksum = self.get_file_checksum(source_item)
+        distribution_points = [
+            repo for repo in self.get_distribution_points() if
+            self.needs_copy(repo, source_item, checksum)]
+        if not distribution_points:
+            return False
+        self.copy(source_item, id_=id_,
+                  distribution_points=distribution_points,
+                  checkpoint=checkpoint)
+        return True
+
+    def get_distribution_points(self):
+        """Return a list of the configured distribution point objects."""
+        # pylint: disable=protected-access
+        return list(self.jss.distribution_points._children)
+
+    def needs_copy(self, repo, source_item, checksum):
+        """Determine whether a file needs to be copied to a DP.
+
+        Args:
+            repo: The distribution point object.
+            source_item: Path to the file to copy.
+            checksum: Dict of the "size" and "sha256" of source_item.
+
+        Returns:
+            True if the file is missing from the DP, if its recorded
+            checksum differs from checksum, or if a previous copy to the
+            DP was interrupted.
+        """
+        filename = os.path.basename(source_item)
+        dp_name = self.get_distribution_point_name(repo)
+        if dp_name in self.get_upload_checkpoint(source_item, checksum):
+            self.output("Resuming interrupted copy of %s to %s." %
+                        (filename, dp_name))
+            return True
+        recorded = self.get_dp_manifest().get(dp_name, {}).get(filename)
+        if recorded is not None and recorded != checksum:
+            self.output("%s differs from the copy on %s." % (filename,
+                                                             dp_name))
+            return True
+        if not repo.exists(filename):
+            self.output("%s is missing from %s." % (filename, dp_name))
+            return True
+        if recorded is None:
+            # Adopt the existing file rather than re-uploading it.
+            self.record_checksum(repo, source_item, checksum)
+        return False
+
+    def get_upload_checkpoint(self, source_item, checksum):
+        """Return the DPs an earlier copy of a file didn't finish.
+
+        The JSS only accepts whole-file uploads, so an interrupted
+        upload to a JDS or CDP can't be continued part way through.
+        However, the package object may already exist, making the DP
+        appear to have the file. The checkpoint, kept beside the file
+        while it is being copied, records which DPs still need the
+        file, so the next run copies it to those DPs (and only those).
+
+        Returns:
+            List of DP names; empty if there is no checkpoint, or if
+            it is for a different version of the file.
+        """
+        try:
+            with open(source_item + ".jssupload", "r") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return []
+        if checkpoint.get("sha256") != checksum["sha256"]:
+            return []
+        return checkpoint.get("incomplete", [])
+
+    def update_upload_checkpoint(self, source_item, checksum, dp_name,
+                                 complete):
+        """Record that a copy to a DP has started or finished.
+
+        The checkpoint file is removed once every copy has finished.
+        """
+        path = source_item + ".jssupload"
+        with self.checksum_lock:
+            incomplete = self.get_upload_checkpoint(source_item, checksum)
+            if complete:
+                incomplete = [name for name in incomplete if name != dp_name]
+            elif dp_name not in incomplete:
+                incomplete.append(dp_name)
+            if incomplete:
+                with open(path, "w") as checkpoint_file:
+                    json.dump({"sha256": checksum["sha256"],
+                               "incomplete": incomplete}, checkpoint_file)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def get_file_checksum(self, path):
+        """Return the size and SHA-256 checksum of a file.
+
+        Checksums are cached by path and modification time, so an
+        unchanged file is only read once. Files are read in chunks,
+        so memory use doesn't depend on the size of the file. In a dry
+        run, new checksums are only cached in memory.
+
+        Returns:
+            Dict with keys "size" and "sha256".
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self.get_file_checksums().get(path)
+        if (cached and cached["mtime"] == stat.st_mtime and
+                cached["size"] == stat.st_size):
+            return {"size": cached["size"], "sha256": cached["sha256"]}
+
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as source:
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        checksum = {"size": stat.st_size, "sha256": sha256.hexdigest()}
+
+        with self.checksum_lock:
+            self.file_checksums[path] = dict(checksum, mtime=stat.st_mtime)
+            if not self.env.get("JSS_DRY_RUN"):
+                self.save_cache_file("file_checksums.json",
+                                     self.file_checksums)
+        return checksum
+
+    def get_file_checksums(self):
+        """Return the cached checksums of local files.
+
+        Returns:
+            Dict of absolute paths, each mapped to a dict of the file's
+            "size", "sha256", and "mtime".
+        """
+        with self.checksum_lock:
+            if self.file_checksums is None:
+                self.file_checksums = self.load_cache_file(
+                    "file_checksums.json")
+            return self.file_checksums
+
+    def get_dp_manifest(self):
+        """Return the checksums of files copied to each DP.
+
+        Returns:
+            Dict of DP names, each mapped to a dict of filenames and
+            their checksums (see get_file_checksum()).
+        """
+        with self.checksum_lock:
+            if self.dp_manifest is None:
+                self.dp_manifest = self.load_cache_file("dp_manifest.json")
+            return self.dp_manifest
+
+    def record_checksum(self, repo, source_item, checksum):
+        """Record the checksum of a file copied to a DP.
+
+        Nothing is recorded in a dry run.
+        """
+        if self.env.get("JSS_DRY_RUN"):
+            return
+        dp_name = self.get_distribution_point_name(repo)
+        manifest = self.get_dp_manifest()
+        with self.checksum_lock:
+            manifest.setdefault(dp_name, {})[
+                os.path.basename(source_item)] = checksum
+            self.save_cache_file("dp_manifest.json", manifest)
+
+    def get_cache_path(self, filename):
+        """Return the path to a file in JSSImporter's cache folder."""
+        cache_dir = os.path.join(
+            os.path.expanduser(self.env.get("CACHE_DIR") or
+                               "~/Library/AutoPkg/Cache"), "JSSImporter")
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return os.path.join(cache_dir, filename)
+
+    def load_cache_file(self, filename):
+        """Return the contents of a JSON cache file, or an empty dict."""
+        try:
+            with open(self.get_cache_path(filename), "r") as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save_cache_file(self, filename, data):
+        """Atomically write data to a JSON cache file."""
+        path = self.get_cache_path(filename)
+        temp_path = "%s.%s.%s.tmp" % (path, os.getpid(),
+                                      threading.current_thread().ident)
+        with open(temp_path, "w") as cache_file:
+            json.dump(data, cache_file)
+        os.rename(temp_path, path)
+
+    # pylint: disable=no-self-use
+    def get_distribution_point_name(self, repo):
+        """Return a human-readable name for a distribution point."""
+        connection = getattr(repo, "connection", {})
+        return (connection.get("url") or connection.get("mount_point") or
+                repo.__class__.__name__)
+    # pylint: enable=no-self-use
+
     def build_replace_dict(self):
         """Build dict of replacement values based on available input."""
         # First, add in AutoPkg's env, excluding types that don't make
@@ -634,8 +2935,9 @@ class JSSImporter(Processor):
 
         # Next, add in "official" and Legacy input variables.
         replace_dict["VERSION"] = self.version
-        if self.package is not None:
-            replace_dict["PKG_NAME"] = self.package.name
+        if self.package_handling_enabled():
+            # The package object is named after the package file.
+            replace_dict["PKG_NAME"] = self.pkg_name
         replace_dict["PROD_NAME"] = self.env.get("prod_name")
         if self.env.get("site_id"):
             replace_dict["SITE_ID"] = self.env.get("site_id")
@@ -666,7 +2968,7 @@ class JSSImporter(Processor):
 
     # pylint: disable=too-many-arguments
     def update_or_create_new(self, obj_cls, template_path, name="",
-                             added_env="", update_env=""):
+                             added_env="", update_env="", replace_dict=None):
         """Check for an existing object and update it, or create a new
         object.
 
@@ -680,58 +2982,195 @@ class JSSImporter(Processor):
                 added.
             update_env: The environment var to update if an object is
                 updated.
+            replace_dict: Dict of text replacement values to use for
+                the template. Defaults to self.replace_dict.
 
         Returns:
             The recipe object after updating.
         """
+        start = time.time()
         # Create a new object from the template
-        recipe_object = self.get_templated_object(obj_cls, template_path)
+        recipe_object = self.get_templated_object(obj_cls, template_path,
+                                                  replace_dict)
 
         if not name:
             name = recipe_object.name
 
-        # Check for an existing object with this name.
-        existing_object = None
-        try:
-            existing_object = self.jss.factory.get_object(obj_cls, name)
-        except jss.JSSGetError:
-            pass
+        with self.timings.object(obj_cls.__name__, name, start) as timing, \
+                self.object_lock(obj_cls, name):
+            # Check for an existing object with this name.
+            existing_object = None
+            try:
+                existing_object = self.get_jss_object(obj_cls, name,
+                                                      live=True)
+            except jss.JSSGetError:
+                pass
 
-        # If object is a Policy, we need to inject scope, scripts,
-        # package, and an icon.
-        if obj_cls is jss.Policy:
-            if existing_object is not None:
-                # If this policy already exists, and it has an icon set,
-                # copy its icon section to our template, as we have no
-                # other way of getting this information.
-                icon_xml = existing_object.find(
-                    "self_service/self_service_icon")
+            # If object is a Policy, we need to inject scope, scripts,
+            # package, and an icon.
+            if obj_cls is jss.Policy:
+                icon_xml = self.get_policy_icon_xml(existing_object)
                 if icon_xml is not None:
                     self.add_icon_to_policy(recipe_object, icon_xml)
-            self.add_scope_to_policy(recipe_object)
-            self.add_scripts_to_policy(recipe_object)
-            self.add_package_to_policy(recipe_object)
-
-        if existing_object is not None:
-            # Update the existing object.
-            url = existing_object.get_object_url()
-            self.jss.put(url, recipe_object)
-            # Retrieve the updated XML.
-            recipe_object = self.jss.factory.get_object(obj_cls, name)
-            self.output("%s: %s updated." % (obj_cls.__name__, name))
-            if update_env:
-                self.env["jss_changed_objects"][update_env].append(name)
-        else:
-            # Object doesn't exist yet.
-            recipe_object.save()
-            self.output("%s: %s created." % (obj_cls.__name__, name))
-            if added_env:
-                self.env["jss_changed_objects"][added_env].append(name)
+                self.add_scope_to_policy(recipe_object)
+                self.add_scripts_to_policy(recipe_object)
+                self.add_package_to_policy(recipe_object)
+
+            if existing_object is not None:
+                if self.objects_match(recipe_object, existing_object):
+                    # Nothing to change; don't write to the JSS.
+                    recipe_object = existing_object
+                    self.output("%s: %s already up to date, moving on..." %
+                                (obj_cls.__name__, name))
+                    timing["action"] = "unchanged"
+                else:
+                    # Update the existing object.
+                    url = existing_object.get_object_url()
+                    self.save_object(recipe_object, url=url, name=name)
+                    # The JSS has accepted exactly what we sent, so rather
+                    # than retrieving the updated XML, just carry the
+                    # existing object's id over to our copy.
+                    self.copy_object_id(existing_object, recipe_object)
+                    self.output("%s: %s updated." % (obj_cls.__name__, name))
+                    timing["action"] = "updated"
+                    if update_env:
+                        self.record_change(update_env, name)
+            else:
+                # Object doesn't exist yet.
+                self.save_object(recipe_object, name=name)
+                self.output("%s: %s created." % (obj_cls.__name__, name))
+                timing["action"] = "created"
+                if added_env:
+                    self.record_change(added_env, name)
 
         return recipe_object
     # pylint: enable=too-many-arguments
 
-    def get_templated_object(self, obj_cls, template_path):
+    def objects_match(self, recipe_object, existing_object):
+        """Determine whether saving an object would change the JSS.
+
+        The JSS fills in every element that a template leaves out, so
+        only the elements present in the recipe object are compared.
+        Repeated elements (e.g. the groups in a policy's scope) are
+        compared in order, and must have the same number of items.
+
+        Smart group criteria are compared as a whole once normalized
+        (see get_normalized_criteria()), as saving a smart group makes
+        the JSS recalculate its membership, which is expensive.
+
+        Args:
+            recipe_object: The templated JSSObject to be saved.
+            existing_object: The JSSObject as currently on the JSS.
+
+        Returns:
+            True if every element of recipe_object matches
+            existing_object, False otherwise.
+        """
+        criteria = recipe_object.find("criteria")
+        if criteria is not None and (
+                self.get_normalized_criteria(criteria) !=
+                self.get_normalized_criteria(
+                    existing_object.find("criteria"))):
+            return False
+        return self._element_matches(recipe_object, existing_object,
+                                     skip=("criteria",))
+
+    def get_normalized_criteria(self, criteria):
+        """Return smart group criteria in a comparable form.
+
+        Criteria are put in order of priority (the JSS returns them in
+        that order, whatever order the template has them in), and
+        fields the JSS fills in if left out are given their defaults.
+
+        Args:
+            criteria: A smart group's criteria element, or None.
+
+        Returns:
+            Sorted list of a tuple for each criterion.
+        """
+        if criteria is None:
+            return []
+        normalized = []
+        for index, criterion in enumerate(criteria.findall("criterion")):
+            priority = self._normalize_text(criterion.findtext("priority"))
+            normalized.append((
+                int(priority) if priority.isdigit() else index,
+                self._normalize_text(criterion.findtext("name")),
+                self._normalize_text(
+                    criterion.findtext("and_or") or "and").lower(),
+                self._normalize_text(
+                    criterion.findtext("search_type")).lower(),
+                self._normalize_text(criterion.findtext("value")),
+                self._normalize_text(
+                    criterion.findtext("opening_paren") or "false"),
+                self._normalize_text(
+                    criterion.findtext("closing_paren") or "false")))
+        return sorted(normalized)
+
+    def _element_matches(self, element, existing, skip=()):
+        """Recursively compare an XML element to its existing version.
+
+        Args:
+            element: The element to be saved.
+            existing: The element as currently on the JSS.
+            skip: Tags of element's children to leave out of the
+                comparison.
+        """
+        # The JSS gives each list a size element (e.g. an empty list
+        # of scripts is <scripts><size>0</size></scripts>), which
+        # templates leave out, so sizes aren't compared.
+        children = [child for child in element if child.tag != "size"]
+        if not children:
+            if not self._is_empty_list(existing):
+                # An empty element clears an existing list.
+                return False
+            return (self._normalize_text(element.text) ==
+                    self._normalize_text(existing.text))
+
+        for tag in OrderedDict((child.tag, None) for child in children):
+            if tag in skip:
+                continue
+            children = element.findall(tag)
+            existing_children = existing.findall(tag)
+            if len(children) != len(existing_children):
+                return False
+            for child, existing_child in zip(children, existing_children):
+                if not self._element_matches(child, existing_child):
+                    return False
+        return True
+
+    def _is_empty_list(self, element):
+        """Return whether an element holds no items, only sizes.
+
+        e.g. <packages><size>0</size></packages>, or a
+        <package_configuration> holding only that.
+        """
+        return all(child.tag == "size" or (
+            not self._normalize_text(child.text) and
+            len(child) and self._is_empty_list(child))
+                   for child in element)
+
+    def _normalize_text(self, text):   # pylint: disable=no-self-use
+        """Normalize XML text for comparison."""
+        text = (text or "").replace("\r\n", "\n").strip()
+        if text.lower() in ("true", "false"):
+            text = text.lower()
+        return text
+
+    def copy_object_id(self, source, destination):
+        """Set destination's id to that of source.
+
+        Most objects keep their id in "general/id"; some (e.g.
+        ComputerGroup) keep it at the top level.
+        """
+        if source.find("general/id") is not None:
+            path = "general/id"
+        else:
+            path = "id"
+        self.ensure_xml_structure(destination, path).text = source.id
+
+    def get_templated_object(self, obj_cls, template_path,
+                             replace_dict=None):
         """Return an object based on a template located in search path.
 
         Args:
@@ -740,6 +3179,8 @@ class JSSImporter(Processor):
             template_path: String filename or path to template file.
                 See find_file_in_search_path() for more information on
                 file searching.
+            replace_dict: Dict of text replacement values. Defaults to
+                self.replace_dict.
 
         Returns:
             A JSS Object created based on the template,
@@ -747,12 +3188,36 @@ class JSSImporter(Processor):
         """
         final_template_path = self.find_file_in_search_path(template_path)
 
-        # Open and return a new object.
-        with open(final_template_path, "r") as template_file:
-            text = template_file.read()
-        template = self.replace_text(text, self.replace_dict)
+        # Return a new object.
+        if replace_dict is None:
+            replace_dict = self.replace_dict
+        template, unresolved = self.get_template(final_template_path).render(
+            replace_dict)
+        if unresolved:
+            self.output("Unresolved tags in %s: %s" %
+                        (final_template_path,
+                         ", ".join("%%%s%%" % tag for tag in unresolved)),
+                        verbose_level=2)
         return obj_cls.from_string(self.jss, template)
 
+    def get_template(self, path):   # pylint: disable=no-self-use
+        """Return the Template for a file, reading it only if needed.
+
+        Templates are cached by path, size, and modification time, and
+        shared by every JSSImporter run in this process.
+        """
+        stat = os.stat(path)
+        with TEMPLATE_CACHE_LOCK:
+            cached = TEMPLATE_CACHE.get(path)
+        if cached and cached[0] == (stat.st_mtime, stat.st_size):
+            return cached[1]
+
+        with open(path, "r") as template_file:
+            template = Template(template_file.read())
+        with TEMPLATE_CACHE_LOCK:
+            TEMPLATE_CACHE[path] = ((stat.st_mtime, stat.st_size), template)
+        return template
+
     def find_file_in_search_path(self, path):
         """Search search_paths for the first existing instance of path.
 
@@ -771,6 +3236,10 @@ class JSSImporter(Processor):
         support using recipe overrides. It allows users to avoid having
         to copy templates, icons, etc, to the override directory.
 
+        Results are cached for every JSSImporter run in this process,
+        and reused as long as none of the folders searched have been
+        modified (i.e. had files added, removed, or renamed).
+
         Args:
             obj_cls: JSSObject class (for the purposes of JSSIMporter a
                 Policy or a ComputerGroup)
@@ -801,7 +3270,20 @@ class JSSImporter(Processor):
             unique_parent_dirs[parent] = parent
         search_dirs = ([os.path.dirname(path)] + unique_parent_dirs.keys())
 
+        # Reuse the last result for this search, unless any of the
+        # folders searched have changed since. (Stat-ing a few folders
+        # is much cheaper than looking for files which don't exist,
+        # especially on network volumes.)
+        cache_key = (filename, tuple(search_dirs))
+        with SEARCH_PATH_CACHE_LOCK:
+            cached = SEARCH_PATH_CACHE.get(cache_key)
+        if cached and all(self.get_dir_mtime(searched) == mtime for
+                          searched, mtime in cached[1]):
+            self.output("Found file: %s" % cached[0])
+            return cached[0]
+
         tested = []
+        searched = []
         final_path = ""
         # Look for the first file that exists in the search_dirs and
         # their parent folders.
@@ -809,6 +3291,9 @@ class JSSImporter(Processor):
             test_path = os.path.join(search_dir, filename)
             test_parent_folder_path = os.path.abspath(
                 os.path.join(search_dir, "..", filename))
+            for folder in (test_path, test_parent_folder_path):
+                folder = os.path.dirname(folder)
+                searched.append((folder, self.get_dir_mtime(folder)))
             if os.path.exists(test_path):
                 final_path = test_path
             elif os.path.exists(test_parent_folder_path):
@@ -825,24 +3310,16 @@ class JSSImporter(Processor):
                 "Unable to find file %s at any of the following locations: %s"
                 % (filename, tested))
 
+        with SEARCH_PATH_CACHE_LOCK:
+            SEARCH_PATH_CACHE[cache_key] = (final_path, searched)
         return final_path
 
-    def replace_text(self, text, replace_dict):   # pylint: disable=no-self-use
-        """Substitute items in a text string.
-
-        Args:
-            text: A string with embedded %tags%.
-            replace_dict: A dict, where
-                key: Corresponds to the % delimited tag in text.
-                value: Text to swap in.
-
-        Returns:
-            The text after replacement.
-        """
-        for key, value in replace_dict.iteritems():
-            # Wrap our keys in % to match template tags.
-            text = text.replace("%%%s%%" % key, value)
-        return text
+    def get_dir_mtime(self, path):   # pylint: disable=no-self-use
+        """Return a folder's modification time, or None if missing."""
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
 
     def validate_input_var(self, var):   # pylint: disable=no-self-use
         """Validate the value before trying to add a group.
@@ -865,31 +3342,43 @@ class JSSImporter(Processor):
 
     def add_or_update_smart_group(self, group):
         """Either add a new group or update existing group."""
-        # Build the template group object
-        self.replace_dict["group_name"] = group["name"]
-        if group.get("site_id"):
-            self.replace_dict["site_id"] = group.get("site_id")
-        if group.get("site_name"):
-            self.replace_dict["site_name"] = group.get("site_name")
         computer_group = self.update_or_create_new(
             jss.ComputerGroup, group["template_path"],
-            update_env="jss_group_updated", added_env="jss_group_added")
+            update_env="jss_group_updated", added_env="jss_group_added",
+            replace_dict=self.get_group_replace_dict(group))
 
         return computer_group
 
+    def get_group_replace_dict(self, group):
+        """Return the text replacement values for a smart group."""
+        # Each group gets its own replacement values, so that groups
+        # can be handled concurrently.
+        replace_dict = dict(self.replace_dict)
+        replace_dict["group_name"] = group["name"]
+        if group.get("site_id"):
+            replace_dict["site_id"] = group.get("site_id")
+        if group.get("site_name"):
+            replace_dict["site_name"] = group.get("site_name")
+        return replace_dict
+
     def add_or_update_static_group(self, group):
         """Either add a new group or update existing group."""
         # Check for pre-existing group first
-        try:
-            computer_group = self.jss.ComputerGroup(group["name"])
-            self.output("Computer Group: %s already exists." %
-                        computer_group.name)
-        except jss.JSSGetError:
-            computer_group = jss.ComputerGroup(self.jss, group["name"])
-            computer_group.save()
-            self.output("Computer Group: %s created." % computer_group.name)
-            self.env["jss_changed_objects"]["jss_group_added"].append(
-                computer_group.name)
+        with self.timings.object("ComputerGroup", group["name"]) as timing, \
+                self.object_lock(jss.ComputerGroup, group["name"]):
+            try:
+                computer_group = self.get_jss_object(jss.ComputerGroup,
+                                                     group["name"])
+                self.output("Computer Group: %s already exists." %
+                            computer_group.name)
+                timing["action"] = "unchanged"
+            except jss.JSSGetError:
+                computer_group = jss.ComputerGroup(self.jss, group["name"])
+                self.save_object(computer_group)
+                timing["action"] = "created"
+                self.output("Computer Group: %s created." %
+                            computer_group.name)
+                self.record_change("jss_group_added", computer_group.name)
 
         return computer_group
 
@@ -916,6 +3405,55 @@ class JSSImporter(Processor):
                                       "package_configuration/packages")
             policy_template.add_package(self.package)
 
+    def get_policy_icon_xml(self, existing_policy):
+        """Return the icon XML to add to a templated policy, if any.
+
+        If the recipe's icon is already on the JSS (see find_icon()),
+        the policy is given it directly, so that it doesn't need
+        uploading. Otherwise, if this policy already exists, and it has
+        an icon set, its icon section is kept, as we have no other way
+        of getting this information (handle_icon() replaces it if it
+        differs from the recipe's).
+
+        Args:
+            existing_policy: The Policy on the JSS, or None.
+        """
+        if existing_policy is not None:
+            # Every policy's icon is added to the icon registry, so
+            # that other recipes can use it.
+            existing_icon = self.get_policy_icon(existing_policy)
+            if existing_icon is not None:
+                self.register_icon(existing_icon)
+
+        if self.env.get("self_service_icon"):
+            try:
+                icon_path = self.find_file_in_search_path(
+                    self.env["self_service_icon"])
+            except ProcessorError:
+                # handle_icon() will report this.
+                icon_path = None
+            if icon_path is not None:
+                known_icon = self.find_icon(
+                    self.get_file_checksum(icon_path)["sha256"],
+                    os.path.basename(icon_path))
+                if known_icon is not None:
+                    return self.make_icon_xml(known_icon)
+
+        if existing_policy is not None:
+            return existing_policy.find("self_service/self_service_icon")
+        return None
+
+    def make_icon_xml(self, icon):  # pylint: disable=no-self-use
+        """Return self_service_icon XML for an icon on the JSS.
+
+        Args:
+            icon: Dict describing the icon (see get_policy_icon()).
+        """
+        icon_xml = ElementTree.Element("self_service_icon")
+        for key in ("id", "filename", "uri"):
+            ElementTree.SubElement(icon_xml, key).text = icon[key]
+        return icon_xml
+
     def add_icon_to_policy(self, policy_template, icon_xml):
         """Add an icon to a self service policy."""
         self.ensure_xml_structure(policy_template, "self_service")
@@ -939,4 +3477,8 @@ class JSSImporter(Processor):
 
 if __name__ == "__main__":
     processor = JSSImporter()   # pylint: disable=invalid-name
-    processor.execute_shell()
+    if "--batch" in sys.argv[1:]:
+        sys.argv.remove("--batch")
+        processor.execute_batch()
+    else:
+        processor.execute_shell()
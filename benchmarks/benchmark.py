@@ -0,0 +1,596 @@
+#!/usr/bin/python
+# Copyright 2014, 2015 Shea Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark JSSImporter against a local stand-in JSS.
+
+Runs JSSImporter's full main() for sets of synthetic recipes, against
+an in-memory JSS REST API server (with optional latency and errors) and
+either a directory-backed (Local) distribution point or a JDS (whose
+uploads the server accepts), and reports the requests made, bytes
+moved, and wall time of each scenario.
+
+Requires python-jss, and AutoPkg's autopkglib (looked for in
+/Library/AutoPkg, or set PYTHONPATH).
+
+Example:
+    ./benchmark.py --recipes 1,50,500 --groups 0,20 --package-sizes 1M,2G \
+        --distribution-points local,jds
+"""
+
+
+from __future__ import print_function
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.append("/Library/AutoPkg")
+import JSSImporter  # pylint: disable=wrong-import-position
+
+
+# Element names of the objects in each JSS API list endpoint.
+LIST_ITEMS = {
+    "categories": "category",
+    "computerextensionattributes": "computer_extension_attribute",
+    "computergroups": "computer_group",
+    "distributionpoints": "distribution_point",
+    "packages": "package",
+    "policies": "policy",
+    "scripts": "script",
+}
+# Elements of JSS objects which are lists. The JSS returns each with a
+# size element, and fills in the lists an object is always given.
+LIST_ELEMENTS = ("buildings", "computer_groups", "computers", "criteria",
+                 "departments", "packages", "scripts")
+DEFAULT_LISTS = {
+    "computer_group": ("criteria", "computers"),
+    "policy": ("scope/computers", "scope/computer_groups",
+               "package_configuration/packages", "scripts"),
+}
+# Where JDS and CDP uploads are POSTed to.
+UPLOAD_PATH = "/dbfileupload"
+OBJECT_PATH = re.compile(
+    r"^/JSSResource/(?P<endpoint>[^/]+)(?:/(?P<key>id|name)/(?P<value>.+))?$")
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+GROUP_TEMPLATE = """<computer_group>
+    <name>%group_name%</name>
+    <is_smart>true</is_smart>
+    <criteria>
+        <criterion>
+            <name>Application Title</name>
+            <priority>0</priority>
+            <and_or>and</and_or>
+            <search_type>is</search_type>
+            <value>%JSS_INVENTORY_NAME%</value>
+        </criterion>
+        <criterion>
+            <name>Application Version</name>
+            <priority>1</priority>
+            <and_or>and</and_or>
+            <search_type>is not</search_type>
+            <value>%VERSION%</value>
+        </criterion>
+    </criteria>
+</computer_group>
+"""
+POLICY_TEMPLATE = """<policy>
+    <general>
+        <name>Install Latest %PROD_NAME%</name>
+        <enabled>true</enabled>
+        <frequency>Ongoing</frequency>
+        <category>
+            <name>%POLICY_CATEGORY%</name>
+        </category>
+    </general>
+    <scope/>
+    <package_configuration/>
+    <scripts/>
+    <self_service>
+        <use_for_self_service>true</use_for_self_service>
+        <install_button_text>Install %VERSION%</install_button_text>
+    </self_service>
+</policy>
+"""
+
+
+class MockJSS(object):
+    """In-memory stand-in for the JSS REST API.
+
+    Objects are created (POST to .../id/0), retrieved (by id, by name,
+    or as a list), and updated (PUT) much as the JSS does. Objects are
+    returned as the JSS would return them (see normalize()), not as
+    they were sent. Files uploaded to the JDS (see upload()) are
+    recorded in files. Every other POST (e.g. icon uploads) is accepted
+    and discarded.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.objects = {}
+        self.files = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Start counting requests and bytes again."""
+        with self.lock:
+            self.stats = {"requests": 0, "methods": {}, "errors": 0,
+                          "bytes_received": 0, "bytes_sent": 0,
+                          "bytes_uploaded": 0}
+
+    def handle(self, method, path, body):
+        """Return the status and body of the response to a request."""
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["methods"][method] = (
+                self.stats["methods"].get(method, 0) + 1)
+            self.stats["bytes_received"] += len(body)
+            if method != "POST" and random.random() < self.error_rate:
+                # Only idempotent requests fail, as JSSImporter never
+                # retries a POST the JSS may have received.
+                self.stats["errors"] += 1
+                return 503, b""
+            status, response = self.dispatch(method, unquote(path), body)
+            self.stats["bytes_sent"] += len(response)
+        return status, response
+
+    def upload(self, headers, size, sha256):
+        """Record a file uploaded to the JDS, and return the response.
+
+        The file itself isn't kept (see MockJSSHandler), only its size
+        and SHA-256 checksum, under its FILE_NAME.
+        """
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["methods"]["POST"] = (
+                self.stats["methods"].get("POST", 0) + 1)
+            self.stats["bytes_received"] += size
+            self.stats["bytes_uploaded"] += size
+            self.files[headers.get("FILE_NAME")] = {
+                "size": size, "sha256": sha256,
+                "object_id": headers.get("OBJECT_ID"),
+                "file_type": headers.get("FILE_TYPE")}
+        return 200, b""
+
+    def dispatch(self, method, path, body):
+        """Handle a request (with the lock held)."""
+        match = OBJECT_PATH.match(path.split("?")[0])
+        if not match or match.group("endpoint") not in LIST_ITEMS:
+            return (201, b"") if method == "POST" else (404, b"")
+        endpoint = match.group("endpoint")
+        objects = self.objects.setdefault(endpoint, {})
+        if method == "GET" and not match.group("key"):
+            listing = ElementTree.Element(endpoint)
+            ElementTree.SubElement(listing, "size").text = str(len(objects))
+            for id_, element in sorted(objects.items()):
+                item = ElementTree.SubElement(listing, LIST_ITEMS[endpoint])
+                ElementTree.SubElement(item, "id").text = str(id_)
+                ElementTree.SubElement(item, "name").text = get_name(element)
+            return 200, ElementTree.tostring(listing)
+
+        id_ = self.find(objects, match.group("key"), match.group("value"))
+        if method == "GET":
+            if id_ is None:
+                return 404, b""
+            return 200, ElementTree.tostring(objects[id_])
+        if method in ("POST", "PUT"):
+            element = ElementTree.fromstring(body)
+            if method == "POST" or id_ is None:
+                id_ = self.next_id
+                self.next_id += 1
+            set_id(element, id_)
+            objects[id_] = normalize(element)
+            return 201, ("<%s><id>%d</id></%s>" % (
+                element.tag, id_, element.tag)).encode("ascii")
+        if method == "DELETE" and id_ is not None:
+            del objects[id_]
+            return 200, b""
+        return 404, b""
+
+    def find(self, objects, key, value):   # pylint: disable=no-self-use
+        """Return the id of the object with an id or name, or None."""
+        if key == "id" and value.isdigit() and int(value) in objects:
+            return int(value)
+        if key == "name":
+            for id_, element in objects.items():
+                if get_name(element).lower() == value.lower():
+                    return id_
+        return None
+
+
+def get_name(element):
+    """Return a JSS object's name."""
+    return element.findtext("name") or element.findtext("general/name") or ""
+
+
+def normalize(element):
+    """Return an object as the JSS would store it.
+
+    Lists (see LIST_ELEMENTS) are always present, and start with their
+    size, and smart group criteria have all of their fields.
+    """
+    for path in DEFAULT_LISTS.get(element.tag, ()):
+        parent = element
+        for tag in path.split("/"):
+            if parent.find(tag) is None:
+                ElementTree.SubElement(parent, tag)
+            parent = parent.find(tag)
+    for child in list(element.iter()):
+        if child.tag in LIST_ELEMENTS:
+            for size in child.findall("size"):
+                child.remove(size)
+            size = ElementTree.Element("size")
+            size.text = str(len(child))
+            child.insert(0, size)
+        elif child.tag == "criterion":
+            for tag in ("opening_paren", "closing_paren"):
+                if child.find(tag) is None:
+                    ElementTree.SubElement(child, tag).text = "false"
+    return element
+
+
+def set_id(element, id_):
+    """Set a JSS object's id, where the JSS would put it."""
+    parent = element.find("general")
+    if parent is None:
+        parent = element
+    id_element = parent.find("id")
+    if id_element is None:
+        id_element = ElementTree.Element("id")
+        parent.insert(0, id_element)
+    id_element.text = str(id_)
+
+
+class MockJSSServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server for a MockJSS."""
+    daemon_threads = True
+
+    def __init__(self, jss):
+        self.jss = jss
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockJSSHandler)
+
+    @property
+    def url(self):
+        """Return the server's base URL."""
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+
+class MockJSSHandler(BaseHTTPRequestHandler):
+    """Pass requests on to the server's MockJSS."""
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        """Respond to a request of any method.
+
+        Uploads to the JDS are checksummed as they arrive rather than
+        read into memory, as packages may be large.
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        if self.path.split("?")[0] == UPLOAD_PATH:
+            sha256 = hashlib.sha256()
+            size = 0
+            for chunk in self.read_body(length):
+                sha256.update(chunk)
+                size += len(chunk)
+            status, response = self.server.jss.upload(
+                self.headers, size, sha256.hexdigest())
+        else:
+            status, response = self.server.jss.handle(
+                self.command, self.path, b"".join(self.read_body(length)))
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def read_body(self, length):
+        """Yield a request's body in chunks of up to 1 MB."""
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        """Don't log requests."""
+        pass
+
+
+def parse_size(size):
+    """Return a number of bytes from a string like "100M"."""
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def make_recipes(work_dir, count, groups, package_size):
+    """Write synthetic packages and templates, and return recipe envs.
+
+    Packages are sparse files, so even multi-GB packages take no time
+    or space to create (but copies of them on the DP aren't sparse).
+    """
+    with open(os.path.join(work_dir, "SmartGroup.xml"), "w") as template:
+        template.write(GROUP_TEMPLATE)
+    with open(os.path.join(work_dir, "Policy.xml"), "w") as template:
+        template.write(POLICY_TEMPLATE)
+    recipes = []
+    for number in range(count):
+        prod_name = "Product%04d" % number
+        pkg_path = os.path.join(work_dir, "%s-1.0.pkg" % prod_name)
+        with open(pkg_path, "wb") as package:
+            package.truncate(package_size)
+        recipes.append({
+            "NAME": prod_name,
+            "RECIPE_DIR": work_dir,
+            "PARENT_RECIPES": [],
+            "prod_name": prod_name,
+            "version": "1.0",
+            "pkg_path": pkg_path,
+            "category": "Benchmark",
+            "policy_category": "Benchmark Policies",
+            "policy_template": os.path.join(work_dir, "Policy.xml"),
+            "groups": [{"name": "%s Group %d" % (prod_name, group),
+                        "smart": True,
+                        "template_path":
+                            os.path.join(work_dir, "SmartGroup.xml")}
+                       for group in range(groups)],
+        })
+    return recipes
+
+
+def get_file_sha256(path):
+    """Return the SHA-256 checksum of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def check_jds_uploads(jss, recipes):
+    """Check that every recipe's package was uploaded to the JDS.
+
+    Raises:
+        BenchmarkError if a package is missing from the JDS, differs
+        from the recipe's, or wasn't uploaded for its package object.
+    """
+    package_ids = {get_name(element): str(id_) for id_, element in
+                   jss.objects.get("packages", {}).items()}
+    for recipe in recipes:
+        filename = os.path.basename(recipe["pkg_path"])
+        uploaded = jss.files.get(filename)
+        if uploaded is None:
+            raise BenchmarkError("%s wasn't uploaded to the JDS." % filename)
+        if uploaded["sha256"] != get_file_sha256(recipe["pkg_path"]):
+            raise BenchmarkError("%s on the JDS (%d bytes) differs from the "
+                                 "recipe's." % (filename, uploaded["size"]))
+        if uploaded["object_id"] != package_ids.get(filename):
+            raise BenchmarkError(
+                "%s was uploaded to the JDS for package id %s, not %s." % (
+                    filename, uploaded["object_id"],
+                    package_ids.get(filename)))
+
+
+def get_tree_size(path):
+    """Return the total size of the files in a folder."""
+    return sum(os.path.getsize(os.path.join(folder, filename))
+               for folder, _, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def run_recipes(settings, recipes, batch):
+    """Import each recipe, as AutoPkg would, or as a batch."""
+    if batch:
+        processor = JSSImporter.JSSImporter(env=dict(settings))
+        processor.process_batch(recipes)
+        return
+    for recipe in recipes:
+        env = dict(settings)
+        env.update(recipe)
+        JSSImporter.JSSImporter(env=env).process()
+
+
+class BenchmarkError(Exception):
+    """A scenario didn't do what it should have."""
+    pass
+
+
+# pylint: disable=too-many-locals
+def run_scenario(args, count, groups, package_size, dp_type):
+    """Run a scenario, and return a list of results for each pass.
+
+    Args:
+        dp_type: The type of distribution point to copy packages to:
+            "local" (a folder), or "jds" (uploads to the mock JSS).
+
+    Raises:
+        BenchmarkError if a pass after the first changed anything on
+        the JSS or the DP, or if the first pass didn't upload every
+        package to the JDS. Any error importing the recipes is raised
+        as is.
+    """
+    work_dir = tempfile.mkdtemp(prefix="jssimporter-benchmark-")
+    jss = MockJSS(latency=args.latency, error_rate=args.error_rate)
+    server = MockJSSServer(jss)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    results = []
+    try:
+        dp_path = os.path.join(work_dir, "CasperShare")
+        os.makedirs(os.path.join(dp_path, "Packages"))
+        os.makedirs(os.path.join(dp_path, "Scripts"))
+        if dp_type == "jds":
+            repos = [{"type": "JDS"}]
+        else:
+            repos = [{"type": "Local", "mount_point": dp_path,
+                      "share_name": "CasperShare"}]
+        settings = {
+            "JSS_URL": server.url,
+            "API_USERNAME": "benchmark",
+            "API_PASSWORD": "benchmark",
+            "JSS_VERIFY_SSL": False,
+            "JSS_REPOS": repos,
+            "CACHE_DIR": os.path.join(work_dir, "Cache"),
+            "JSS_RETRIES": args.retries,
+            "JSS_RETRY_BACKOFF": 0.01,
+            "JSS_WORKERS": args.workers,
+            "JSS_BATCH_WORKERS": args.workers,
+        }
+        recipes = make_recipes(work_dir, count, groups, package_size)
+        # The first pass creates everything; later passes should find
+        # nothing to change.
+        for number in range(1, args.passes + 1):
+            jss.reset_stats()
+            dp_size = get_tree_size(dp_path)
+            start = time.time()
+            run_recipes(settings, recipes, args.batch)
+            result = {"recipes": count, "groups": groups,
+                      "package_size": package_size,
+                      "distribution_point": dp_type, "pass": number,
+                      "seconds": round(time.time() - start, 3),
+                      "requests": jss.stats["requests"],
+                      "requests_by_method": jss.stats["methods"],
+                      "injected_errors": jss.stats["errors"],
+                      "bytes_to_jss": jss.stats["bytes_received"],
+                      "bytes_from_jss": jss.stats["bytes_sent"],
+                      "bytes_to_dp": (get_tree_size(dp_path) - dp_size +
+                                      jss.stats["bytes_uploaded"])}
+            results.append(result)
+            if number == 1 and dp_type == "jds":
+                check_jds_uploads(jss, recipes)
+            writes = sum(result["requests_by_method"].get(method, 0)
+                         for method in ("POST", "PUT", "DELETE"))
+            if number > 1 and (writes or result["bytes_to_dp"]):
+                raise BenchmarkError(
+                    "Pass %d of %d recipes changed what the first pass "
+                    "made: %d writes to the JSS, %d bytes to the DP." % (
+                        number, count, writes, result["bytes_to_dp"]))
+    finally:
+        # Close the connections JSSImporter keeps open for reuse, so the
+        # server's threads aren't left waiting on them.
+        for session in JSSImporter.HTTP_SESSIONS.values():
+            session.close()
+        JSSImporter.HTTP_SESSIONS.clear()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+# pylint: enable=too-many-locals
+
+
+def main():
+    """Run the benchmark scenarios and report the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--recipes", default="1,50",
+                        help="Comma-separated numbers of recipes to import "
+                        "per scenario (default: %(default)s).")
+    parser.add_argument("--groups", default="0,5",
+                        help="Comma-separated numbers of smart groups per "
+                        "recipe (default: %(default)s).")
+    parser.add_argument("--package-sizes", default="1M",
+                        help="Comma-separated package sizes, e.g. 1M,2G "
+                        "(default: %(default)s).")
+    parser.add_argument("--distribution-points", default="local,jds",
+                        help="Comma-separated distribution point types to "
+                        "copy packages to: local, jds (default: "
+                        "%(default)s).")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the JSS takes to respond to each "
+                        "request (default: %(default)s).")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of GET and PUT requests that fail "
+                        "with HTTP 503 (default: %(default)s).")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="JSS_RETRIES (default: %(default)s).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="JSS_WORKERS, and JSS_BATCH_WORKERS with "
+                        "--batch (default: %(default)s).")
+    parser.add_argument("--batch", action="store_true",
+                        help="Import each scenario's recipes as a batch.")
+    parser.add_argument("--passes", type=int, default=2,
+                        help="Times to import each scenario's recipes "
+                        "(default: %(default)s).")
+    parser.add_argument("--output",
+                        help="Path to save the results to as JSON.")
+    args = parser.parse_args()
+
+    dp_types = [value.strip().lower()
+                for value in args.distribution_points.split(",")]
+    for dp_type in dp_types:
+        if dp_type not in ("local", "jds"):
+            parser.error("Unknown distribution point type: %s" % dp_type)
+
+    results = []
+    print("%8s %6s %10s %5s %4s %9s %8s %7s %12s %12s %12s" % (
+        "recipes", "groups", "pkg size", "dp", "pass", "seconds",
+        "requests", "errors", "to jss", "from jss", "to dp"))
+    for count, groups, size, dp_type in itertools.product(
+            [int(value) for value in args.recipes.split(",")],
+            [int(value) for value in args.groups.split(",")],
+            [parse_size(value) for value in args.package_sizes.split(",")],
+            dp_types):
+        try:
+            scenario_results = run_scenario(args, count, groups, size,
+                                            dp_type)
+        except BenchmarkError as error:
+            sys.exit("FAILED: %s" % error)
+        for result in scenario_results:
+            results.append(result)
+            print("%8d %6d %10s %5s %4d %9.2f %8d %7d %12s %12s %12s" % (
+                count, groups, JSSImporter.format_size(size), dp_type,
+                result["pass"], result["seconds"], result["requests"],
+                result["injected_errors"],
+                JSSImporter.format_size(result["bytes_to_jss"]),
+                JSSImporter.format_size(result["bytes_from_jss"]),
+                JSSImporter.format_size(result["bytes_to_dp"])))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
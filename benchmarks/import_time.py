@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Copyright 2014, 2015 Shea Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure how long it takes to import JSSImporter.
+
+AutoPkg imports JSSImporter for every recipe which uses it, whether or
+not the recipe gets as far as running it. This imports JSSImporter in
+a fresh interpreter a number of times, and reports the median time the
+import took, and which heavy dependencies it brought in. With
+--baseline, the JSSImporter.py from a git revision is measured too, for
+comparison.
+
+Requires python-jss, and AutoPkg's autopkglib (looked for in
+/Library/AutoPkg, or set PYTHONPATH).
+
+Example:
+    ./import_time.py --runs 20 --baseline HEAD~1
+"""
+
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules JSSImporter used to import when it was loaded.
+HEAVY_MODULES = ("jss", "requests", "urllib3", "distutils.version")
+MEASURE = """
+import json, sys, time
+sys.path[:0] = [%r]
+sys.path.append("/Library/AutoPkg")
+import autopkglib
+start = time.time()
+import JSSImporter
+print(json.dumps({"seconds": time.time() - start,
+                  "modules": [name for name in %r if name in sys.modules]}))
+"""
+
+
+def measure(source_dir, runs):
+    """Import JSSImporter from source_dir in runs fresh interpreters.
+
+    autopkglib is imported first, so that only JSSImporter's own
+    imports are timed.
+
+    Returns:
+        Dict of the "median" and "best" import times in seconds, and
+        the heavy "modules" the import loaded.
+    """
+    times = []
+    modules = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", MEASURE % (source_dir, HEAVY_MODULES)])
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+        times.append(result["seconds"])
+        modules = result["modules"]
+    times.sort()
+    return {"median": times[len(times) // 2], "best": times[0],
+            "modules": modules}
+
+
+def export_revision(revision, work_dir):
+    """Write JSSImporter.py from a git revision to work_dir."""
+    source = subprocess.check_output(
+        ["git", "show", "%s:JSSImporter.py" % revision], cwd=REPO_DIR)
+    with open(os.path.join(work_dir, "JSSImporter.py"), "wb") as output:
+        output.write(source)
+
+
+def main():
+    """Measure import times, and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Number of imports to time (default: 10).")
+    parser.add_argument("--baseline",
+                        help="A git revision to compare against, e.g. HEAD~1.")
+    args = parser.parse_args()
+
+    scenarios = [("working tree", REPO_DIR)]
+    work_dir = None
+    if args.baseline:
+        work_dir = tempfile.mkdtemp()
+        export_revision(args.baseline, work_dir)
+        scenarios.insert(0, (args.baseline, work_dir))
+    try:
+        for name, source_dir in scenarios:
+            result = measure(source_dir, args.runs)
+            print("%-16s median %7.1f ms, best %7.1f ms, loaded: %s" % (
+                name, result["median"] * 1000, result["best"] * 1000,
+                ", ".join(result["modules"]) or "none"))
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# Copyright 2014, 2015 Shea Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for JSSImporter.
+
+Requires requests, and AutoPkg's autopkglib (looked for in
+/Library/AutoPkg, or set PYTHONPATH). python-jss isn't needed.
+
+Example:
+    python -m unittest discover tests
+"""
+
+
+from functools import partial
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.append("/Library/AutoPkg")
+import JSSImporter  # pylint: disable=wrong-import-position
+
+
+ICON = b"\x89PNG not really an icon"
+
+
+class IconHandler(BaseHTTPRequestHandler):
+    """Serve ICON, noting each request's Authorization header."""
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Respond with the icon."""
+        self.server.authorizations.append(self.headers.get("Authorization"))
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(ICON)))
+        self.end_headers()
+        self.wfile.write(ICON)
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        """Don't log requests."""
+        pass
+
+
+class FakeJSS(object):   # pylint: disable=too-few-public-methods
+    """Stand-in for a python-jss JSS client, with an API session."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.auth = ("api-user", "api-password")
+
+
+class IconDownloadTest(unittest.TestCase):
+    """Existing icons are only downloaded with credentials from the JSS."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = HTTPServer(("127.0.0.1", 0), IconHandler)
+        self.server.authorizations = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = self.server.server_address[1]
+        # localhost and 127.0.0.1 are the same server, but different
+        # hosts as far as credentials go.
+        self.jss_url = "http://localhost:%d" % port
+        self.foreign_uri = "http://127.0.0.1:%d/icon.png" % port
+        self.processor = JSSImporter.JSSImporter(
+            env={"JSS_URL": self.jss_url, "CACHE_DIR": self.cache_dir})
+        self.processor.jss = FakeJSS()
+
+    def tearDown(self):
+        self.processor.jss.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_foreign_icon_host_gets_no_credentials(self):
+        """find_icon() doesn't send the API credentials elsewhere."""
+        self.processor.register_icon(
+            {"id": "1", "filename": "icon.png", "uri": self.foreign_uri})
+        icon = self.processor.find_icon(hashlib.sha256(ICON).hexdigest(),
+                                        "icon.png")
+        self.assertEqual(icon["id"], "1")
+        self.assertEqual(self.server.authorizations, [None])
+
+    def test_jss_icon_uses_api_session(self):
+        """Icons on the JSS itself are downloaded with the API session."""
+        checksum = self.processor.get_icon_checksum(
+            {"id": "2", "filename": "icon.png",
+             "uri": self.jss_url + "/icon.png"})
+        self.assertEqual(checksum, hashlib.sha256(ICON).hexdigest())
+        self.assertEqual(len(self.server.authorizations), 1)
+        self.assertTrue(self.server.authorizations[0].startswith("Basic "))
+
+
+class RunTasksTest(unittest.TestCase):
+    """A failed task only stops the tasks which depend on it."""
+
+    def run_tasks(self, workers):
+        """Run a failing task, a task depending on it, and two others.
+
+        Returns:
+            List of the names of the tasks which ran.
+        """
+        processor = JSSImporter.JSSImporter(env={"JSS_WORKERS": workers})
+        ran = []
+
+        def task(name, error=None):
+            """Note that the task ran, then raise error, if any."""
+            ran.append(name)
+            if error is not None:
+                raise error
+
+        error = ValueError("category failed")
+        tasks = [("category", partial(task, "category", error), []),
+                 ("scripts", partial(task, "scripts"), []),
+                 ("package", partial(task, "package"), ["category"]),
+                 ("extattrs", partial(task, "extattrs"), [])]
+        with self.assertRaises(ValueError) as context:
+            processor.run_tasks(tasks)
+        self.assertIs(context.exception, error)
+        return ran
+
+    def test_one_worker(self):
+        """With one worker, independent tasks after a failure run."""
+        self.assertEqual(self.run_tasks(1),
+                         ["category", "scripts", "extattrs"])
+
+    def test_several_workers(self):
+        """With several workers, independent tasks run too."""
+        self.assertEqual(sorted(self.run_tasks(4)),
+                         ["category", "extattrs", "scripts"])
+
+
+if __name__ == "__main__":
+    unittest.main()